@@ -9,10 +9,16 @@ mus = unique(A(:,1));
 vars = unique(A(:,2));
 
 diss = (A(:,4) - mean(A(:,4)))/std(A(:,4));
-diss = reshape(diss,[length(mus) length(vars)]);
 eff = (A(:,3) - mean(A(:,3)))/std(A(:,3));
-eff = reshape(eff,[length(mus) length(vars)]);
 [X,Y]= meshgrid(mus,vars);
+if size(A,1) == length(mus)*length(vars)
+    diss = reshape(diss,[length(mus) length(vars)]);
+    eff = reshape(eff,[length(mus) length(vars)]);
+else
+    % Points of an adaptive sweep (pedsim.py --adaptive) do not fill the grid, interpolate them onto it
+    diss = griddata(A(:,1),A(:,2),diss,X,Y);
+    eff = griddata(A(:,1),A(:,2),eff,X,Y);
+end
 
 subplot(1,2,1);
 surf(X,Y,eff);
@@ -0,0 +1,122 @@
+import numpy as np
+from metrics import confidenceInterval
+
+# Adaptive sweep over (mean, variance). It starts from the uniform grid of means x variances and improves it in two ways:
+#  - Repetitions: every point runs minRepetitions jobs and then one more per round until the 95% confidence
+#    intervals of both its mean efficiency and mean discomfort are narrower than +- ciTolerance, or it has run maxRepetitions.
+#  - Refinement: once all points are done, every grid cell whose corners differ by more than refineThreshold in
+#    efficiency or discomfort is split into four, adding its edge midpoints and centre, up to maxLevel times.
+# Flat regions of the parameter space thus keep the coarse grid and few repetitions.
+#
+# Points are keyed by their (i, j) index on the finest grid, which has 2**maxLevel intervals per coarse interval.
+# Points of the coarse grid use the random streams of the uniform sweep, spawn key (i, j, repetition),
+# refined points get spawn key (i, j, repetition, maxLevel) on the fine grid.
+class AdaptiveSweep:
+    def __init__(self, means, variances, minRepetitions, maxRepetitions, ciTolerance, refineThreshold, maxLevel):
+        self.means = np.asarray(means, dtype=float)
+        self.variances = np.asarray(variances, dtype=float)
+        self.maxRepetitions = max(1, maxRepetitions)
+        self.minRepetitions = min(max(1, minRepetitions), self.maxRepetitions)
+        self.ciTolerance = ciTolerance
+        self.refineThreshold = refineThreshold
+        self.maxLevel = maxLevel
+        self.scale = 2**maxLevel
+        self.level = 0
+        self.results = {} # (i, j) -> list of [efficiency, discomfort], one per finished repetition
+        self.done = set()
+        for i in range(len(self.means)):
+            for j in range(len(self.variances)):
+                self.results[(i*self.scale, j*self.scale)] = []
+        # Cells of the current level as (i, j, size) on the fine grid, a dimension with a single point has cells of width 0
+        self.steps = (self.scale if len(self.means) > 1 else 0, self.scale if len(self.variances) > 1 else 0)
+        self.cells = [(i*self.scale, j*self.scale, self.scale) for i in range(max(len(self.means)-1, 1)) for j in range(max(len(self.variances)-1, 1))]
+        if self.steps == (0, 0):
+            self.cells = []
+
+    def parameters(self, point):
+        i, j = point
+        return self.interpolate(self.means, i), self.interpolate(self.variances, j)
+
+    def interpolate(self, values, index):
+        coarse, fine = divmod(index, self.scale)
+        if fine == 0:
+            return values[coarse]
+        return values[coarse] + (values[coarse+1] - values[coarse])*fine/float(self.scale)
+
+    def spawnKey(self, point, repetition):
+        i, j = point
+        if i % self.scale == 0 and j % self.scale == 0:
+            return (i//self.scale, j//self.scale, repetition)
+        return (i, j, repetition, self.maxLevel)
+
+    # (point, repetition) of the jobs to run next: up to minRepetitions for new points, otherwise one more for every unfinished point
+    def pending(self):
+        jobs = []
+        for point in sorted(self.results):
+            if point in self.done:
+                continue
+            numRuns = len(self.results[point])
+            for repetition in range(numRuns, max(numRuns + 1, self.minRepetitions)):
+                jobs.append((point, repetition))
+        return jobs
+
+    # Adds the result of the next repetition of point, returns True if that finished the point
+    def add(self, point, result):
+        self.results[point].append(result)
+        if self.converged(point):
+            self.done.add(point)
+            return True
+        return False
+
+    def converged(self, point):
+        results = np.array(self.results[point], dtype=float).reshape(-1, 2)
+        if len(results) < self.minRepetitions:
+            return False
+        if len(results) >= self.maxRepetitions:
+            return True
+        return confidenceInterval(results[:, 0])[1] < self.ciTolerance and confidenceInterval(results[:, 1])[1] < self.ciTolerance
+
+    # [mean efficiency, mean discomfort] of a point over its repetitions
+    def measures(self, point):
+        return np.mean(np.array(self.results[point], dtype=float).reshape(-1, 2), 0)
+
+    # Splits the cells of the current level where the metrics change by more than refineThreshold.
+    # Returns the number of points added, 0 when the sweep is finished.
+    def refine(self):
+        if self.level >= self.maxLevel:
+            return 0
+        children = set()
+        numPoints = len(self.results)
+        for cell in self.cells:
+            corners = self.corners(cell)
+            values = np.array([self.measures(corner) for corner in corners])
+            if np.nanmax(np.ptp(values, 0)) <= self.refineThreshold:
+                continue
+            i, j, size = cell
+            half = size//2
+            for (di, dj) in [(0, 0), (1, 0), (0, 1), (1, 1)]:
+                children.add((i + di*half*(self.steps[0] > 0), j + dj*half*(self.steps[1] > 0), half))
+        for child in children:
+            for corner in self.corners(child):
+                if corner not in self.results:
+                    self.results[corner] = []
+        self.cells = sorted(children)
+        self.level += 1
+        return len(self.results) - numPoints
+
+    def corners(self, cell):
+        i, j, size = cell
+        di = size if self.steps[0] > 0 else 0
+        dj = size if self.steps[1] > 0 else 0
+        return sorted(set([(i, j), (i + di, j), (i, j + dj), (i + di, j + dj)]))
+
+    # Rows (mean, variance, efficiency, discomfort) of all points, ordered by mean and variance
+    def table(self):
+        rows = []
+        for point in sorted(self.results):
+            if self.results[point]:
+                rows.append(tuple(self.parameters(point)) + tuple(self.measures(point)))
+        return rows
+
+    def numRuns(self):
+        return sum(len(results) for results in self.results.values())
@@ -1,73 +1,120 @@
 import numpy as np
 import time
-import warnings
-warnings.filterwarnings("ignore", category=np.VisibleDeprecationWarning)
+
+# Model constants shared by the per-agent update below and the vectorized engine
+RELAXATION = 0.02
+WALL_SCALAR = 1.5
+WALL_WIDTH = 0.1
+RMIN1 = 2.0**2 #Because comparison done with squared euclidean distance as opposed to euclidean distance (dot faster than norm)
+RMIN2 = 1.5**2
+COULUMB_SCALAR1 = 10.0
+COULUMB_SCALAR2 = 15.0
+Y_MAGNIFICATION1 = 1.5
+Y_MAGNIFICATION2 = 2.5
+MAX_SPEED = 10.0
+
+# Property which reads/writes row self.index of the PedsimState array called arrayName
+def _rowView(arrayName):
+    return property(lambda self: getattr(self.state, arrayName)[self.index],
+                    lambda self, value: getattr(self.state, arrayName).__setitem__(self.index, value))
 
 # An agent which given a list of agents is capable of
-# updating its position, velocity and acceleration
-class Agent:    
-    def __init__(self, initialPosition, preferredVelocity, agentGroup):
-        self.position = initialPosition
-        self.position0 = np.copy(self.position)
-        self.preferredVelocity = preferredVelocity
-        self.velocity = np.copy(self.preferredVelocity)
-        self.acceleration = np.array([0.0, 0.0])
-        self.relaxation = 0.02
-        self.agentGroup = agentGroup
-        self.inGoal = False
-        self.cumVelocity = np.array([0.0, 0.0])
-        self.cumSpeed = 0
-        self.cumSpeedPreferred = 0
-        self.cumSpeedSquared = 0
-        self.preferredSpeed = np.linalg.norm(self.preferredVelocity)
-        
-    # Behavioral force f_alpha(t) is the acceleration plus a fluctuation term
+# updating its position, velocity and acceleration.
+# An agent does not own any data, it is a view onto row index of the
+# agent arrays held by a PedsimState. Array attributes (position, velocity, ...)
+# are returned as row views so in-place updates such as agent.position += v
+# write straight through to the state.
+class Agent:
+    def __init__(self, state, index):
+        self.state = state
+        self.index = index
+        self.relaxation = RELAXATION
+
+    # Two views of the same row are the same agent, views may be created on demand (see AgentSequence)
+    def __eq__(self, other):
+        return isinstance(other, Agent) and other.state is self.state and other.index == self.index
+
+    def __hash__(self):
+        return hash((id(self.state), self.index))
+
+    position = _rowView("positions")
+    position0 = _rowView("positions0")
+    velocity = _rowView("velocities")
+    preferredVelocity = _rowView("preferredVelocities")
+    acceleration = _rowView("accelerations")
+    agentGroup = _rowView("groups")
+    inGoal = _rowView("inGoal")
+    preferredSpeed = _rowView("preferredSpeeds")
+    cumVelocity = _rowView("cumVelocity")
+    cumSpeed = _rowView("cumSpeed")
+    cumSpeedPreferred = _rowView("cumSpeedPreferred")
+    cumSpeedSquared = _rowView("cumSpeedSquared")
+
+    # Behavioral force f_alpha(t) is the acceleration plus a fluctuation term.
     def behavioral(self, agents, boundaries, attractors):
+        return self.socialForce(agents, boundaries, attractors) + self.fluctuation()
+
+    # Behavioral force without the fluctuation. It only reads the other agents (and writes the agent's own preferred velocity),
+    # so the synchronous AgentEngine can evaluate all agents in any order against the same state.
+    # attractors, if not None, steers the preferred velocity along the flow field of the agent's goal (see navigation.py)
+    def socialForce(self, agents, boundaries, attractors):
+        self.steer(attractors)
         return (self.preferredVelocity - self.velocity)/self.relaxation + \
-        self.repulsiveEffects(boundaries) + self.repulsiveInteractions(agents) + \
-        self.fluctuation()
-    
+        self.repulsiveEffects(boundaries) + self.repulsiveInteractions(agents)
+
+    # Wall and interaction forces, socialForce without the relaxation term (for integrators which treat it implicitly)
+    def externalForce(self, agents, boundaries, attractors):
+        self.steer(attractors)
+        return self.repulsiveEffects(boundaries) + self.repulsiveInteractions(agents)
+
+    def steer(self, attractors):
+        if attractors is not None:
+            self.preferredVelocity = self.preferredSpeed*attractors.preferredDirections(self.position[np.newaxis, :], np.array([self.agentGroup]))[0]
+
     def fluctuation(self):
         MAX = 1; MIN = -1
-        return np.random.random(2) * (MAX-MIN) + MIN
+        return self.state.rng.random(2) * (MAX-MIN) + MIN
 
     def repulsiveEffects(self, boundaries):
+        position = self.state.positions[self.index]
+        if self.state.obstacleMap is not None:
+            return self.state.obstacleMap.wallForces(position[np.newaxis, :])[0]
         s = np.shape(boundaries)
         upperBound = s[0]-1
         lowerBound = 0
-        distanceToLower = abs(self.position[1] - lowerBound)
-        distanceToHigher = abs(self.position[1] - upperBound)
-        WALL_SCALAR = 1.5
-        
+        distanceToLower = abs(position[1] - lowerBound)
+        distanceToHigher = abs(position[1] - upperBound)
+
         if distanceToLower < distanceToHigher:
             return np.array([0.0, 1.0]) * (np.exp(WALL_SCALAR/distanceToLower) - 1.0)
         return np.array([0.0, -1.0]) * (np.exp(WALL_SCALAR/distanceToHigher) - 1.0)
 
-    
+
+    # agents are views of the rows of this agent's state, whose arrays are read directly in the loop over them
     def repulsiveInteractions(self, agents):
         # Almost Coulomb potential, Q = 1 temporary?
         sum1 = np.array([0.0, 0.0]);
         sum2 = np.array([0.0, 0.0]);
-        rmin1 = 2.0**2 #Because comparison done with squared euclidean distance as opposed to euclidean distance (dot faster than norm)
-        rmin2 = 1.5**2
-        COULUMB_SCALAR1 = 10.0
-        COULUMB_SCALAR2 = 15.0
-        Y_MAGNIFICATION1 = 1.5
-        Y_MAGNIFICATION2 = 2.5
-        
+        positions = self.state.positions
+        groups = self.state.groups
+        index = self.index
+        position = positions[index]
+        group = groups[index]
 
         for agent in agents:
-            if(agent != self):
-                rab = self.position - agent.position
+            other = agent.index
+            if(other != index):
+                rab = position - positions[other]
                 rabdot = np.dot(rab, rab)
-                sameGroup = self.agentGroup == agent.agentGroup
-                if sameGroup and (rabdot < rmin1):
+                sameGroup = group == groups[other]
+                if sameGroup and (rabdot < RMIN1):
                     sum1 += rab/rabdot
-                if not sameGroup and (rabdot < rmin2):
+                if not sameGroup and (rabdot < RMIN2):
                     sum2 += rab/rabdot
         return np.multiply(COULUMB_SCALAR1*sum1, np.array([1.0, Y_MAGNIFICATION1])) + np.multiply(COULUMB_SCALAR2*sum2, np.array([1.0, Y_MAGNIFICATION2]))
 
         # DO NOT REMOVE! THIS IS _MUCH_FASTER FOR NUM_AGENTS >= 200
+        # (superseded by pairForces in pedsimengine.py, which does this for all agents at once)
         #g = self.agentGroup != np.matrix([agent.agentGroup for agent in agents if agent != self]).T
         #rab = -np.matrix([agent.position for agent in agents if agent != self]) + self.position;
         #rabdot = np.square(rab).sum(1);
@@ -76,38 +123,45 @@ class Agent:
         #COULUMB_SCALAR2 *= g
         #COULUMB_SCALAR2[rabdot > rmin2] = 0.0
         #return ((rab / rabdot).T * (COULUMB_SCALAR2 + COULUMB_SCALAR1)).A1
-        
+
+    # Rows of the state arrays are bound to locals once, they are views which write through to the state
     def update(self, state, pedsim):
-        self.acceleration = self.behavioral(state.agents, state.boundaryMap, state.attractors)
-        self.velocity += self.acceleration * state.dt
-        if(self.agentGroup == 0 and (self.velocity[0] < 0)):
-            self.velocity[0] = 0.01
-        if(self.agentGroup == 1 and (self.velocity[0] > 0)):
-            self.velocity[0] = -0.01
+        index = self.index
+        position = state.positions[index]
+        velocity = state.velocities[index]
+        group = state.groups[index]
+        state.accelerations[index] = self.behavioral(state.agents, state.boundaryMap, state.attractors)
+        velocity += state.accelerations[index] * state.dt
+        if(group == 0 and (velocity[0] < 0)):
+            velocity[0] = 0.01
+        if(group == 1 and (velocity[0] > 0)):
+            velocity[0] = -0.01
 
         # Cap magnitude of vector to 12.4m/s (Usain Bolt 2009 Berlin)
-        velocityMagnitude = np.linalg.norm(self.velocity)
-        MAX_SPEED = 10.0;
+        velocityMagnitude = np.linalg.norm(velocity)
         if(velocityMagnitude > MAX_SPEED):
-            self.velocity = self.velocity / velocityMagnitude * MAX_SPEED;
+            velocity[:] = velocity / velocityMagnitude * MAX_SPEED;
 
-        self.position += self.velocity * state.dt
+        position += velocity * state.dt
 
         # Confine agents within boundary
-        WALL_WIDTH = 0.1;
-        self.position[1] = np.clip(self.position[1], 0+WALL_WIDTH, np.size(state.boundaryMap, 0)-1-WALL_WIDTH)
+        position[1] = np.clip(position[1], 0+WALL_WIDTH, np.size(state.boundaryMap, 0)-1-WALL_WIDTH)
+        if(state.obstacleMap is not None):
+            state.obstacleMap.confine(position[np.newaxis, :])
 
         # Check if agents reached goal
+        reachedGoal = self.goal(state)
+        state.goalCounts[self.index] += reachedGoal
         if(pedsim.continuous):
-            state.numAgentsInGoal += self.goal(state)
+            state.numAgentsInGoal += reachedGoal
             if(self.inGoal):
                 self.position[0] = self.position0[0]
                 #self.velocity = self.preferredVelocity
                 #self.position[1] = np.random.uniform(1,6)
                 self.inGoal = False
         else:
-            state.numAgentsInGoal += self.goal(state)
-        
+            state.numAgentsInGoal += reachedGoal
+
 
     # Method that returns 1 (true) if agent is at other side of goal line, otherwise 0 (false)
     def goal(self, state):
@@ -117,4 +171,30 @@ class Agent:
             else:
                 self.inGoal = self.position[0] < state.goalLineLeft
             return self.inGoal;
-        return 0
\ No newline at end of file
+        return 0
+
+# Sequence of Agent views onto the first state.numAgents rows of a PedsimState which creates each Agent when it is accessed,
+# so a state holds no Python object per agent. Used by compact states in place of a list of agents.
+# Given a list of views of all rows (agents), it hands those out instead, e.g. for the agent pool of an open boundary.
+class AgentSequence:
+    def __init__(self, state, agents=None):
+        self.state = state
+        self.agents = agents
+
+    def __len__(self):
+        return self.state.numAgents
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("agent index out of range")
+        if self.agents is not None:
+            return self.agents[index]
+        return Agent(self.state, index)
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self.agents[index] if self.agents is not None else Agent(self.state, index)
@@ -0,0 +1,240 @@
+import numpy as np
+import time
+import argparse
+import warnings
+import json
+import os
+import sys
+import platform
+import tracemalloc
+from pedsim import Pedsim
+from pedsimstate import PedsimState
+import forcekernel
+import metrics
+
+# Benchmarks of the simulation core, run headless against Pedsim.simulate and PedsimState:
+#   steps    steps per second of every engine/neighbor search/kernel against the number of agents
+#   forces   time of one force evaluation (engine.forces) against the number of agents
+#   metrics  time of metrics.accumulate per step, also relative to the time of the step itself
+#   sweep    sweep jobs per second of Pedsim.runJobs, one by one and as an ensemble
+#   memory   peak memory of building a state and stepping it, and the same per agent
+# Results are written as JSON and optionally compared with a baseline JSON file from an earlier run,
+# e.g. python benchmark.py -output new.json -baseline baseline.json
+# A result key (e.g. "steps/vectorized/grid/numba/n=1000") is the same in every run, so results of
+# different runs are compared key by key.
+
+AGENT_COUNTS = [10, 100, 1000, 10000]
+QUICK_AGENT_COUNTS = [10, 100, 1000]
+# (engine, neighborSearch, kernel) and the largest number of agents it is benchmarked with,
+# brute force needs numAgents^2 memory and the agent engine is a Python loop over agents
+CONFIGURATIONS = [('vectorized', 'grid', 'numba', None),
+                  ('vectorized', 'grid', 'numpy', None),
+                  ('vectorized', 'bruteforce', 'numpy', 2000),
+                  ('agent', 'bruteforce', 'numpy', 100)]
+# Initial density of agents spread over the corridor (agents per square meter)
+DENSITY = 1.0
+# Metrics where a larger value is better, for all others a smaller value is better
+HIGHER_IS_BETTER = ['stepsPerSecond', 'agentStepsPerSecond', 'jobsPerSecond']
+
+# Boundary map of a corridor as wide as Boundarymap.boundaryMap1 and long enough for numAgents at density
+def corridorMap(numAgents, density=DENSITY):
+    width = 7
+    length = max(15, int(np.ceil(numAgents/(density*(width-3)))) + 8)
+    boundaryMap = np.zeros((width, length), dtype='bool')
+    boundaryMap[0, :] = 1
+    boundaryMap[-1, :] = 1
+    return boundaryMap
+
+# PedsimState with its agents spread uniformly over the whole corridor, so every crowd size runs at the same density
+def corridorState(numAgents, boundaryMap, dt, seed, compact=False):
+    state = PedsimState(numAgents, dt, boundaryMap, 1.0, 0.5, np.random.default_rng(seed), None, compact)
+    state.positions[:, 0] = state.rng.uniform(1, np.size(boundaryMap, 1)-2, numAgents)
+    state.positions0[:] = state.positions
+    return state
+
+def benchmarkPedsim(numAgents, boundaryMap, engine, neighborSearch, kernel, dt):
+    return Pedsim(numAgents, False, False, 16, dt, 1, 1, False, True, False, False, 1, boundaryMap, engine=engine, neighborSearch=neighborSearch, kernel=kernel)
+
+# Calls function repeatedly for at least minTime seconds (and at most maxCalls times) after warmup calls,
+# returns the seconds per call of the fastest of repeats such measurements
+def timeCalls(function, minTime, maxCalls, warmup=2, repeats=3):
+    for k in range(warmup):
+        function()
+    best = np.inf
+    for k in range(repeats):
+        numCalls = 0
+        start = time.perf_counter()
+        while True:
+            function()
+            numCalls += 1
+            elapsed = time.perf_counter() - start
+            if elapsed >= minTime or numCalls >= maxCalls:
+                break
+        best = min(best, elapsed/numCalls)
+    return best
+
+def benchmarkSteps(numAgents, engine, neighborSearch, kernel, dt, minTime):
+    boundaryMap = corridorMap(numAgents)
+    pedsim = benchmarkPedsim(numAgents, boundaryMap, engine, neighborSearch, kernel, dt)
+    state = corridorState(numAgents, boundaryMap, dt, 0)
+    secondsPerStep = timeCalls(lambda: pedsim.simulate(state), minTime, 10000)
+    return {'secondsPerStep': secondsPerStep, 'stepsPerSecond': 1.0/secondsPerStep,
+            'agentStepsPerSecond': numAgents/secondsPerStep}
+
+def benchmarkForces(numAgents, neighborSearch, kernel, dt, minTime):
+    boundaryMap = corridorMap(numAgents)
+    pedsim = benchmarkPedsim(numAgents, boundaryMap, 'vectorized', neighborSearch, kernel, dt)
+    state = corridorState(numAgents, boundaryMap, dt, 0)
+    return {'forceTime': timeCalls(lambda: pedsim.engine.forces(state), minTime, 10000)}
+
+def benchmarkMetrics(numAgents, dt, minTime):
+    boundaryMap = corridorMap(numAgents)
+    pedsim = benchmarkPedsim(numAgents, boundaryMap, 'vectorized', 'grid', 'auto', dt)
+    state = corridorState(numAgents, boundaryMap, dt, 0)
+    state.lastDt = dt
+    accumulateTime = timeCalls(lambda: metrics.accumulate(state), minTime, 100000)
+    stepTime = timeCalls(lambda: pedsim.simulate(state), minTime, 10000)
+    return {'accumulateTime': accumulateTime, 'overhead': accumulateTime/stepTime}
+
+# Runs numJobs sweep jobs of numAgents agents in the 15 m corridor of boundaryMap1, like Pedsim.run does without writing files
+def benchmarkSweep(numAgents, numJobs, workers, ensembleSize, dt):
+    boundaryMap = corridorMap(0)
+    pedsim = Pedsim(numAgents, False, False, 16, dt, 1, 1, False, False, False, True, numJobs, boundaryMap,
+                    workers=workers, ensembleSize=ensembleSize)
+    jobs = pedsim.makeJobs([1.0], [0.5], np.random.SeedSequence(0))
+    start = time.perf_counter()
+    results = list(pedsim.runJobs(jobs))
+    elapsed = time.perf_counter() - start
+    return {'sweepTime': elapsed, 'jobsPerSecond': len(results)/elapsed}
+
+# Peak bytes allocated while building a state with its engine and stepping it numSteps times (numpy allocations are traced too)
+def benchmarkMemory(numAgents, engine, neighborSearch, kernel, dt, compact=False, numSteps=3):
+    boundaryMap = corridorMap(numAgents)
+    tracemalloc.start()
+    pedsim = benchmarkPedsim(numAgents, boundaryMap, engine, neighborSearch, kernel, dt)
+    state = corridorState(numAgents, boundaryMap, dt, 0, compact)
+    for k in range(numSteps):
+        pedsim.simulate(state)
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {'stateBytes': current, 'peakBytes': peak, 'peakBytesPerAgent': peak/float(numAgents), 'agentBytesPerAgent': state.memoryPerAgent()}
+
+def configurationName(engine, neighborSearch, kernel):
+    return '%s/%s/%s' % (engine, neighborSearch, kernel)
+
+# Runs all benchmarks and returns the JSON report, progress is printed as each result comes in
+def runBenchmarks(agentCounts, minTime, dt, workers, sweepJobs):
+    results = {}
+    def report(key, values):
+        results[key] = values
+        print('%-45s %s' % (key, ', '.join('%s %.6g' % (name, value) for name, value in sorted(values.items()))))
+        sys.stdout.flush()
+    kernels = ['numba', 'numpy'] if forcekernel.numbaAvailable else ['numpy']
+
+    for numAgents in agentCounts:
+        for (engine, neighborSearch, kernel, maxAgents) in CONFIGURATIONS:
+            if kernel not in kernels or (maxAgents is not None and numAgents > maxAgents):
+                continue
+            report('steps/%s/n=%d' % (configurationName(engine, neighborSearch, kernel), numAgents),
+                   benchmarkSteps(numAgents, engine, neighborSearch, kernel, dt, minTime))
+    for numAgents in agentCounts:
+        for (engine, neighborSearch, kernel, maxAgents) in CONFIGURATIONS:
+            if engine != 'vectorized' or kernel not in kernels or (maxAgents is not None and numAgents > maxAgents):
+                continue
+            report('forces/%s/%s/n=%d' % (neighborSearch, kernel, numAgents), benchmarkForces(numAgents, neighborSearch, kernel, dt, minTime))
+    for numAgents in agentCounts:
+        report('metrics/n=%d' % numAgents, benchmarkMetrics(numAgents, dt, minTime))
+    for ensembleSize in [1, 4]:
+        report('sweep/n=20/jobs=%d/workers=%d/ensemble=%d' % (sweepJobs, workers, ensembleSize),
+               benchmarkSweep(20, sweepJobs, workers, ensembleSize, dt))
+    for numAgents in agentCounts:
+        for (engine, neighborSearch, kernel, maxAgents) in CONFIGURATIONS:
+            if engine != 'vectorized' or kernel not in kernels or (maxAgents is not None and numAgents > maxAgents):
+                continue
+            for compact in [False, True]:
+                report('memory/%s%s/n=%d' % (configurationName(engine, neighborSearch, kernel), '/compact' if compact else '', numAgents),
+                       benchmarkMemory(numAgents, engine, neighborSearch, kernel, dt, compact))
+
+    return {'machine': machineInfo(), 'settings': {'agentCounts': agentCounts, 'minTime': minTime, 'dt': dt,
+            'workers': workers, 'sweepJobs': sweepJobs, 'density': DENSITY}, 'results': results}
+
+def machineInfo():
+    info = {'python': platform.python_version(), 'numpy': np.__version__, 'platform': platform.platform(),
+            'processor': platform.processor(), 'cpuCount': os.cpu_count(),
+            'numba': forcekernel.numbaVersion(),
+            'date': time.strftime('%Y-%m-%d %H:%M:%S')}
+    try:
+        import resource
+        info['maxRssKilobytes'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    except ImportError:
+        pass
+    return info
+
+# Fastest steps configuration for every number of agents, {numAgents: (configuration, stepsPerSecond)}
+def bestConfigurations(report):
+    best = {}
+    for key, values in report['results'].items():
+        parts = key.split('/')
+        if parts[0] != 'steps':
+            continue
+        numAgents = int(parts[-1][2:])
+        if numAgents not in best or values['stepsPerSecond'] > best[numAgents][1]:
+            best[numAgents] = ('/'.join(parts[1:-1]), values['stepsPerSecond'])
+    return best
+
+# Compares every metric of report with the same metric of baseline. Returns a list of
+# (key, metric, baselineValue, value, change) where change > 0 means worse, and the subset worse than tolerance
+def compare(report, baseline, tolerance):
+    comparisons = []
+    for key in sorted(report['results']):
+        if key not in baseline['results']:
+            continue
+        for metric, value in sorted(report['results'][key].items()):
+            baselineValue = baseline['results'][key].get(metric)
+            if not baselineValue:
+                continue
+            change = (value - baselineValue)/abs(baselineValue)
+            if metric in HIGHER_IS_BETTER:
+                change = -change
+            comparisons.append((key, metric, baselineValue, value, change))
+    regressions = [comparison for comparison in comparisons if comparison[4] > tolerance]
+    return comparisons, regressions
+
+def main():
+    warnings.filterwarnings("ignore", category=np.VisibleDeprecationWarning)
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-output", help="Sets JSON file results are written to", type=str, default='benchmark.json')
+    parser.add_argument("-baseline", help="Compare results with this JSON file of an earlier run", type=str, default=None)
+    parser.add_argument("-tolerance", help="Sets relative change counted as a regression", type=float, default=0.1)
+    parser.add_argument("-n", help="Sets numbers of agents to benchmark", type=int, nargs='+', default=None)
+    parser.add_argument("-mintime", help="Sets seconds each timing runs for at least", type=float, default=0.2)
+    parser.add_argument("-dt", help="Sets delta time", type=float, default=0.01)
+    parser.add_argument("-j", "--workers", help="Sets number of processes of the sweep benchmark", type=int, default=1)
+    parser.add_argument("-jobs", help="Sets number of jobs of the sweep benchmark", type=int, default=8)
+    parser.add_argument("--quick", help="Only benchmark up to 1000 agents", action='store_true')
+    args = parser.parse_args()
+
+    agentCounts = args.n if args.n is not None else (QUICK_AGENT_COUNTS if args.quick else AGENT_COUNTS)
+    report = runBenchmarks(agentCounts, args.mintime, args.dt, args.workers, args.jobs)
+
+    print('')
+    for numAgents, (configuration, stepsPerSecond) in sorted(bestConfigurations(report).items()):
+        print('Fastest with %d agents: %s, %.1f steps/s' % (numAgents, configuration, stepsPerSecond))
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+    print('Results written to %s' % args.output)
+
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        comparisons, regressions = compare(report, baseline, args.tolerance)
+        print('')
+        for (key, metric, baselineValue, value, change) in comparisons:
+            print('%-45s %-20s %12.6g -> %12.6g  %+6.1f%%%s' % (key, metric, baselineValue, value, -100.0*change if metric in HIGHER_IS_BETTER else 100.0*change,
+                                                              '  REGRESSION' if change > args.tolerance else ''))
+        print('%d of %d metrics regressed by more than %.0f%%' % (len(regressions), len(comparisons), 100.0*args.tolerance))
+        if regressions:
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,187 @@
+import numpy as np
+import multiprocessing
+import multiprocessing.shared_memory
+import weakref
+from agent import *
+from neighborgrid import NeighborGrid
+from pedsimengine import VectorizedEngine, pairForcesFromPairs
+import forcekernel
+
+# Domain decomposition of one large simulation over numSlabs worker processes, for runs with more agents than one
+# core steps in reasonable time. The corridor is split along x into slabs holding equal numbers of agents, recomputed
+# every step from the positions, so agents migrate between slabs simply by walking across a slab boundary.
+# Each worker computes the repulsive (and with the numba kernel the total) force on the agents of its slab. It sees
+# them and the agents in a halo of at least cutoff = sqrt(max(RMIN1, RMIN2)) on either side (one column of grid cells),
+# which holds every agent they interact with. The agent arrays are passed through shared memory, the parent only sends slab bounds.
+#
+# The workers sort their agents into the same NeighborGrid as the single process run (same origin and cells, agents
+# in the order of their index, see NeighborGrid.rebuildOn), so every agent sums the same terms in the same order and
+# the forces, and with them the whole run, are bit for bit those of VectorizedEngine with grid neighbor search.
+# Driving forces, fluctuations, obstacle map walls and the integration are O(numAgents) and stay in the parent.
+#
+# The workers are started the first time forces are computed and stopped by close(). Like the thread pool of
+# ArrayEngine they are not copied with the engine, a copy starts its own.
+class DecomposedEngine(VectorizedEngine):
+    ARRAYS = ['positions', 'velocities', 'preferredVelocities', 'groups', 'noise', 'forces']
+
+    def __init__(self, neighborSearch='grid', kernel='auto', integrator=None, numSlabs=2):
+        VectorizedEngine.__init__(self, 'grid', kernel, integrator)
+        self.numSlabs = numSlabs
+        self.workers = None
+        self.memories = {}
+        self.arrays = {}
+        self.finalizer = None
+
+    def __getstate__(self):
+        state = VectorizedEngine.__getstate__(self)
+        state.update(workers=None, memories={}, arrays={}, finalizer=None)
+        return state
+
+    def kernelForces(self, state, noise, preferredVelocities=None):
+        start = self.profiler.clock()
+        if preferredVelocities is None:
+            preferredVelocities = state.preferredVelocities
+        forces = self.slabForces(state, 'kernel', noise, preferredVelocities)
+        if state.obstacleMap is not None:
+            forces += state.obstacleMap.wallForces(state.positions)
+        self.profiler.record('forceKernel', start)
+        return forces
+
+    def interactionForces(self, state):
+        start = self.profiler.clock()
+        forces = self.slabForces(state, 'pairs')
+        self.profiler.record('pairForces', start)
+        return forces
+
+    # Forces on all agents of state computed by the workers, kind 'kernel' with the compiled kernel and 'pairs' only
+    # the repulsion between agents. Returns a new array.
+    def slabForces(self, state, kind, noise=None, preferredVelocities=None):
+        numAgents = state.numAgents
+        if numAgents == 0:
+            return np.zeros((0, 2))
+        self.share(state, numAgents)
+        arrays = self.arrays
+        arrays['positions'][:numAgents] = state.positions
+        arrays['groups'][:numAgents] = state.groups
+        if kind == 'kernel':
+            arrays['velocities'][:numAgents] = state.velocities
+            arrays['preferredVelocities'][:numAgents] = preferredVelocities
+            arrays['noise'][:numAgents] = noise
+        origin, numCells = self.grid.extent(state.positions, state.boundaryMap)
+        bounds = self.slabBounds(state.positions[:, 0])
+        task = (kind, numAgents, origin, numCells, self.grid.cellSize, float(np.size(state.boundaryMap, 0)-1), state.obstacleMap is None)
+        for (k, connection) in enumerate(self.workers):
+            connection.send(('forces', bounds[k], bounds[k+1]) + task)
+        for connection in self.workers:
+            connection.recv()
+        return np.array(arrays['forces'][:numAgents])
+
+    # Slab k holds the agents with bounds[k] <= x < bounds[k+1], each about numAgents/numSlabs of them
+    def slabBounds(self, x):
+        bounds = np.full(self.numSlabs + 1, np.inf)
+        bounds[0] = -np.inf
+        if len(x):
+            ranks = (np.arange(1, self.numSlabs)*len(x))//self.numSlabs
+            bounds[1:-1] = np.partition(x, ranks)[ranks]
+        return [float(bound) for bound in bounds]
+
+    # Starts the workers and (re)allocates the shared arrays when they are too small for numAgents agents
+    def share(self, state, numAgents):
+        if self.workers is None:
+            context = multiprocessing.get_context('spawn')
+            self.workers = []
+            processes = []
+            for k in range(self.numSlabs):
+                connection, workerConnection = context.Pipe()
+                process = context.Process(target=_runSlabWorker, args=(workerConnection,), daemon=True)
+                process.start()
+                self.workers.append(connection)
+                processes.append(process)
+            self.finalizer = weakref.finalize(self, _stopWorkers, self.workers, processes, self.memories)
+        capacity = len(self.arrays['positions']) if self.arrays else 0
+        if self.arrays and numAgents <= capacity and self.arrays['positions'].dtype == state.positions.dtype:
+            return
+        capacity = max(numAgents, 2*capacity, 1)
+        dtypes = {'positions': state.positions.dtype, 'velocities': state.velocities.dtype,
+                  'preferredVelocities': state.preferredVelocities.dtype, 'groups': state.groups.dtype,
+                  'noise': np.dtype(float), 'forces': np.dtype(float)}
+        layout = {}
+        self.arrays.clear()
+        for name in self.ARRAYS:
+            shape = (capacity,) if name == 'groups' else (capacity, 2)
+            memory = multiprocessing.shared_memory.SharedMemory(create=True, size=max(1, int(np.prod(shape))*dtypes[name].itemsize))
+            layout[name] = (memory.name, dtypes[name].str, shape)
+            self.arrays[name] = np.ndarray(shape, dtypes[name], memory.buf)
+            if name in self.memories:
+                self.memories[name].close()
+                self.memories[name].unlink()
+            self.memories[name] = memory
+        for connection in self.workers:
+            connection.send(('attach', layout))
+
+    # Stops the workers and frees the shared memory, the engine starts them again if it is used afterwards
+    def close(self):
+        self.arrays.clear()
+        if self.finalizer is not None:
+            self.finalizer()
+        self.workers = None
+        self.memories = {}
+        self.finalizer = None
+
+def _stopWorkers(workers, processes, memories):
+    for connection in workers:
+        try:
+            connection.send(('stop',))
+        except (BrokenPipeError, OSError):
+            pass
+    for process in processes:
+        process.join()
+    for memory in memories.values():
+        memory.close()
+        memory.unlink()
+
+# Main loop of a slab worker process: attaches to the shared arrays and computes the forces on the agents of its slab
+def _runSlabWorker(connection):
+    memories = []
+    arrays = {}
+    grid = NeighborGrid(np.sqrt(max(RMIN1, RMIN2)))
+    while True:
+        message = connection.recv()
+        if message[0] == 'stop':
+            break
+        if message[0] == 'attach':
+            arrays = {}
+            for memory in memories:
+                memory.close()
+            memories = []
+            for (name, (memoryName, dtype, shape)) in message[1].items():
+                memory = multiprocessing.shared_memory.SharedMemory(memoryName)
+                memories.append(memory)
+                arrays[name] = np.ndarray(shape, np.dtype(dtype), memory.buf)
+            continue
+        lower, upper, kind, numAgents, origin, numCells, cellSize, upperBound, corridorWalls = message[1:]
+        positions = arrays['positions'][:numAgents]
+        x = positions[:, 0]
+        inSlab = (x >= lower) & (x < upper)
+        if not inSlab.any():
+            connection.send(None)
+            continue
+        # The halo is the column of cells on either side of the slab's cells, the cells its agents visit
+        cellX = np.floor((x - origin[0])/cellSize).astype(int)
+        local = np.flatnonzero((cellX >= cellX[inSlab].min() - 1) & (cellX <= cellX[inSlab].max() + 1))
+        owned = inSlab[local]
+        localPositions = positions[local]
+        localGroups = arrays['groups'][local]
+        grid.rebuildOn(localPositions, origin, numCells)
+        if kind == 'kernel':
+            forces = forcekernel.compiledTotalForces()(localPositions, arrays['velocities'][local], arrays['preferredVelocities'][local],
+                        localGroups, arrays['noise'][local], upperBound, corridorWalls,
+                        int(numCells[0]), int(numCells[1]), grid.cellOfAgent, grid.sortedAgents, grid.cellStart, grid.cellCount, np.empty((len(local), 2)))
+        else:
+            i, j = grid.pairs(localPositions)
+            forces = pairForcesFromPairs(localPositions, localGroups, i, j)
+        arrays['forces'][local[owned]] = forces[owned]
+        connection.send(None)
+    arrays = {}
+    for memory in memories:
+        memory.close()
@@ -0,0 +1,173 @@
+import numpy as np
+from agent import *
+from neighborgrid import NeighborGrid
+from pedsimengine import pairForcesFromPairs
+import forcekernel
+
+# Largest number of pair entries (replicas x numAgents x numAgents) evaluated in one batch
+MAX_PAIR_ENTRIES = 256*1024
+
+# Batched pair forces of several independent replicas, positions is (R, N, 2) and groups (R, N).
+# Same as pedsimengine.pairForces applied to every replica on its own.
+def batchedPairForces(positions, groups):
+    dx = positions[:, :, np.newaxis, 0] - positions[:, np.newaxis, :, 0]
+    dy = positions[:, :, np.newaxis, 1] - positions[:, np.newaxis, :, 1]
+    rabdot = dx*dx + dy*dy
+    numAgents = positions.shape[1]
+    rabdot[:, np.arange(numAgents), np.arange(numAgents)] = np.inf
+    sameGroup = groups[:, :, np.newaxis] == groups[:, np.newaxis, :]
+    w1 = np.where(sameGroup & (rabdot < RMIN1), COULUMB_SCALAR1, 0.0)/rabdot
+    w2 = np.where(~sameGroup & (rabdot < RMIN2), COULUMB_SCALAR2, 0.0)/rabdot
+    wx = w1 + w2
+    wy = Y_MAGNIFICATION1*w1 + Y_MAGNIFICATION2*w2
+    forces = np.empty(np.shape(positions))
+    forces[:, :, 0] = positions[:, :, 0]*wx.sum(2) - np.einsum('rij,rj->ri', wx, positions[:, :, 0])
+    forces[:, :, 1] = positions[:, :, 1]*wy.sum(2) - np.einsum('rij,rj->ri', wy, positions[:, :, 1])
+    return forces
+
+# Several independent PedsimStates with the same number of agents and boundary map, stepped together.
+# The agent arrays of all states are stacked into (R, N, ...) arrays and the arrays of every state are
+# replaced by views into them, so Agent views, metrics and PedsimVisualizer keep working on each state.
+# A step moves all replicas which are still active with one batch of array operations (the 'euler' scheme
+# of Agent.update); finished replicas are masked out. Fluctuations are drawn from the rng of each state,
+# so every replica gives the same run as it would when simulated on its own.
+# neighborSearch and useNumba are taken from the VectorizedEngine the replicas would otherwise run on.
+class Ensemble:
+    ARRAYS = ['positions', 'positions0', 'velocities', 'preferredVelocities', 'accelerations', 'groups', 'inGoal',
+              'goalCounts', 'preferredSpeeds', 'cumVelocity', 'cumSpeed', 'cumSpeedPreferred', 'cumSpeedSquared']
+
+    def __init__(self, states, neighborSearch='grid', useNumba=False):
+        self.states = states
+        self.neighborSearch = neighborSearch
+        self.useNumba = useNumba and neighborSearch == 'grid'
+        self.grid = NeighborGrid(np.sqrt(max(RMIN1, RMIN2)))
+        for name in self.ARRAYS:
+            stacked = np.stack([getattr(state, name) for state in states])
+            setattr(self, name, stacked)
+            for r, state in enumerate(states):
+                setattr(state, name, stacked[r])
+        self.numAgents = states[0].numAgents
+        self.boundaryMap = states[0].boundaryMap
+        self.obstacleMap = states[0].obstacleMap
+        self.attractors = states[0].attractors
+        self.goalLineLeft = np.array([state.goalLineLeft for state in states], dtype=float)
+        self.goalLineRight = np.array([state.goalLineRight for state in states], dtype=float)
+
+    # Sorts the flattened (R*N, 2) positions into one NeighborGrid which finds the pairs of all replicas at once.
+    # Every replica gets the cells it has when simulated on its own (see NeighborGrid.rebuild), laid out next to
+    # each other along x with an empty column of cells in between, so replicas do not interact and each agent
+    # sums the same terms in the same order as in its single-state run. Positions themselves are not shifted.
+    def flatten(self, positions):
+        numReplicas, numAgents = np.shape(positions)[:2]
+        extents = [self.grid.extent(replica, self.boundaryMap) for replica in positions]
+        numCellsY = max(numCells[1] for (origin, numCells) in extents)
+        cells = np.empty((numReplicas, numAgents, 2), dtype=int)
+        firstColumn = 0
+        for r, (origin, numCells) in enumerate(extents):
+            cells[r] = np.floor((positions[r] - origin)/self.grid.cellSize).astype(int)
+            cells[r, :, 0] += firstColumn
+            firstColumn += numCells[0] + 1
+        self.grid.sortInto(cells.reshape(-1, 2), np.array([firstColumn, numCellsY]))
+        return positions.reshape(-1, 2)
+
+    # Pair forces of the selected replicas, (R, N, 2)
+    def pairForces(self, positions, groups):
+        if self.neighborSearch == 'bruteforce':
+            return batchedPairForces(positions, groups)
+        flatPositions = self.flatten(positions)
+        i, j = self.grid.pairs(flatPositions)
+        return pairForcesFromPairs(flatPositions, groups.reshape(-1), i, j).reshape(np.shape(positions))
+
+    # Total force on every agent of the selected replicas, fluctuation included
+    def forces(self, positions, velocities, preferredVelocities, groups, noise):
+        if self.useNumba:
+            flatPositions = self.flatten(positions)
+            forces = forcekernel.arrayTotalForces(flatPositions, velocities.reshape(-1, 2), preferredVelocities.reshape(-1, 2), groups.reshape(-1),
+                                                  noise.reshape(-1, 2), self.boundaryMap, self.grid, self.obstacleMap is None).reshape(np.shape(positions))
+            if self.obstacleMap is not None:
+                forces += self.obstacleMap.wallForces(positions.reshape(-1, 2)).reshape(np.shape(positions))
+            return forces
+        # Same forces as pedsimengine.VectorizedEngine.forces, for all replicas at once
+        if self.obstacleMap is not None:
+            wall = self.obstacleMap.wallForces(positions.reshape(-1, 2)).reshape(np.shape(positions))
+            return (preferredVelocities - velocities)/RELAXATION + wall + self.pairForces(positions, groups) + noise
+        upperBound = np.size(self.boundaryMap, 0)-1
+        distanceToLower = np.abs(positions[:, :, 1])
+        distanceToHigher = np.abs(positions[:, :, 1] - upperBound)
+        closerToLower = distanceToLower < distanceToHigher
+        wall = np.zeros(np.shape(positions))
+        wall[:, :, 1] = np.where(closerToLower,
+                                 np.exp(WALL_SCALAR/np.where(closerToLower, distanceToLower, 1.0)) - 1.0,
+                                 -(np.exp(WALL_SCALAR/np.where(closerToLower, 1.0, distanceToHigher)) - 1.0))
+        return (preferredVelocities - velocities)/RELAXATION + wall + self.pairForces(positions, groups) + noise
+
+    # Advances the replicas selected by the boolean mask active one step with their own state.dt
+    def step(self, active, continuous):
+        replicas = np.flatnonzero(active)
+        if self.neighborSearch == 'grid':
+            self.stepReplicas(replicas, continuous)
+            return
+        chunkSize = max(1, MAX_PAIR_ENTRIES // max(1, self.numAgents*self.numAgents))
+        for chunkStart in range(0, len(replicas), chunkSize):
+            self.stepReplicas(replicas[chunkStart:chunkStart+chunkSize], continuous)
+
+    def stepReplicas(self, replicas, continuous):
+        states = [self.states[r] for r in replicas]
+        dt = np.array([state.dt for state in states])[:, np.newaxis, np.newaxis]
+        positions = self.positions[replicas]
+        velocities = self.velocities[replicas]
+        groups = self.groups[replicas]
+
+        if self.attractors is not None:
+            self.preferredVelocities[replicas] = self.preferredSpeeds[replicas, :, np.newaxis]*self.attractors.preferredDirections(
+                positions.reshape(-1, 2), groups.reshape(-1)).reshape(np.shape(positions))
+        noise = np.stack([state.rng.random((self.numAgents, 2)) * 2 - 1 for state in states])
+        accelerations = self.forces(positions, velocities, self.preferredVelocities[replicas], groups, noise)
+
+        velocities += accelerations * dt
+        group0 = groups == 0
+        vx = velocities[:, :, 0]
+        vx[group0 & (vx < 0)] = 0.01
+        vx[~group0 & (vx > 0)] = -0.01
+        # Cap magnitude of vector to 12.4m/s (Usain Bolt 2009 Berlin)
+        speeds = np.sqrt(np.einsum('rij,rij->ri', velocities, velocities))
+        tooFast = speeds > MAX_SPEED
+        velocities[tooFast] *= (MAX_SPEED/speeds[tooFast])[:, np.newaxis]
+        positions += velocities * dt
+
+        # Confine agents within boundary
+        np.clip(positions[:, :, 1], 0+WALL_WIDTH, np.size(self.boundaryMap, 0)-1-WALL_WIDTH, out=positions[:, :, 1])
+        if self.obstacleMap is not None:
+            self.obstacleMap.confine(positions.reshape(-1, 2))
+
+        # Check if agents reached goal
+        inGoal = self.inGoal[replicas]
+        reachedGoal = ~inGoal & np.where(group0, positions[:, :, 0] > self.goalLineRight[replicas, np.newaxis],
+                                         positions[:, :, 0] < self.goalLineLeft[replicas, np.newaxis])
+        inGoal |= reachedGoal
+        self.goalCounts[replicas] += reachedGoal
+        if continuous:
+            positions[:, :, 0] = np.where(inGoal, self.positions0[replicas, :, 0], positions[:, :, 0])
+            inGoal[:] = False
+
+        self.positions[replicas] = positions
+        self.velocities[replicas] = velocities
+        self.accelerations[replicas] = accelerations
+        self.inGoal[replicas] = inGoal
+        numReached = reachedGoal.sum(1)
+        for k, state in enumerate(states):
+            state.numAgentsInGoal += int(numReached[k])
+
+    # Same as metrics.accumulate for every selected replica
+    def accumulate(self, active):
+        replicas = np.flatnonzero(active)
+        dt = np.array([self.states[r].lastDt for r in replicas])
+        velocities = self.velocities[replicas]
+        speedsSquared = np.einsum('rij,rij->ri', velocities, velocities)
+        speedsPreferred = np.einsum('rij,rij->ri', velocities, self.preferredVelocities[replicas])/self.preferredSpeeds[replicas]
+        self.cumSpeed[replicas] += dt[:, np.newaxis]*np.sqrt(speedsSquared)
+        self.cumVelocity[replicas] += dt[:, np.newaxis, np.newaxis]*velocities
+        self.cumSpeedPreferred[replicas] += dt[:, np.newaxis]*speedsPreferred
+        self.cumSpeedSquared[replicas] += dt[:, np.newaxis]*speedsSquared
+        for k, r in enumerate(replicas):
+            self.states[r].measuredTime += dt[k]
@@ -0,0 +1,95 @@
+import numpy as np
+import importlib.util
+import importlib.metadata
+import warnings
+from agent import *
+
+# Optional compiled force kernel. numba is not a requirement of Pedsim, when it is not installed
+# numbaAvailable is False and the vectorized engine uses the NumPy force functions in pedsimengine.py.
+# numba takes a few hundred milliseconds to import, so it is only imported (and the kernel compiled)
+# the first time a force is computed with it, see compiledTotalForces.
+numbaAvailable = importlib.util.find_spec('numba') is not None
+
+# Total force on every agent: relaxation towards the preferred velocity, exponential wall term,
+# same-group and cross-group almost Coulomb terms with Y_MAGNIFICATION scaling and the fluctuation.
+# Pairs are found through the cell list of a NeighborGrid (cellOfAgent, sortedAgents, cellStart, cellCount on a
+# numCellsX x numCellsY grid) so each agent only visits the 3x3 block of cells around it. fluctuations are drawn by the caller so that the random stream is
+# the same as with the NumPy path. corridorWalls=False leaves out the wall term, for obstacle maps whose
+# wall forces are looked up by the caller. Written as plain loops over scalars, which numba compiles to machine code.
+def _totalForces(positions, velocities, preferredVelocities, groups, fluctuations, upperBound, corridorWalls,
+                 numCellsX, numCellsY, cellOfAgent, sortedAgents, cellStart, cellCount, out):
+    numAgents = positions.shape[0]
+    for i in range(numAgents):
+        x = positions[i, 0]
+        y = positions[i, 1]
+        fx = (preferredVelocities[i, 0] - velocities[i, 0])/RELAXATION + fluctuations[i, 0]
+        fy = (preferredVelocities[i, 1] - velocities[i, 1])/RELAXATION + fluctuations[i, 1]
+
+        if corridorWalls:
+            distanceToLower = abs(y)
+            distanceToHigher = abs(y - upperBound)
+            if distanceToLower < distanceToHigher:
+                fy += np.exp(WALL_SCALAR/distanceToLower) - 1.0
+            else:
+                fy -= np.exp(WALL_SCALAR/distanceToHigher) - 1.0
+
+        sum1x = 0.0; sum1y = 0.0
+        sum2x = 0.0; sum2y = 0.0
+        cellX = cellOfAgent[i] // numCellsY
+        cellY = cellOfAgent[i] % numCellsY
+        for neighborX in range(max(cellX-1, 0), min(cellX+2, numCellsX)):
+            for neighborY in range(max(cellY-1, 0), min(cellY+2, numCellsY)):
+                cell = neighborX*numCellsY + neighborY
+                for k in range(cellStart[cell], cellStart[cell] + cellCount[cell]):
+                    j = sortedAgents[k]
+                    if j == i:
+                        continue
+                    rabx = x - positions[j, 0]
+                    raby = y - positions[j, 1]
+                    rabdot = rabx*rabx + raby*raby
+                    if groups[i] == groups[j]:
+                        if rabdot < RMIN1:
+                            sum1x += rabx/rabdot
+                            sum1y += raby/rabdot
+                    elif rabdot < RMIN2:
+                        sum2x += rabx/rabdot
+                        sum2y += raby/rabdot
+        out[i, 0] = fx + COULUMB_SCALAR1*sum1x + COULUMB_SCALAR2*sum2x
+        out[i, 1] = fy + COULUMB_SCALAR1*Y_MAGNIFICATION1*sum1y + COULUMB_SCALAR2*Y_MAGNIFICATION2*sum2y
+    return out
+
+_compiledTotalForces = None
+
+# _totalForces compiled by numba, or the plain Python loops if numba turns out not to import
+def compiledTotalForces():
+    global _compiledTotalForces
+    if _compiledTotalForces is None:
+        try:
+            import numba
+            _compiledTotalForces = numba.njit(cache=True)(_totalForces)
+        except ImportError:
+            warnings.warn("numba failed to import, the compiled force kernel runs as plain Python")
+            _compiledTotalForces = _totalForces
+    return _compiledTotalForces
+
+def numbaVersion():
+    return importlib.metadata.version('numba') if numbaAvailable else None
+
+# Total force on all agents of state in one compiled call. grid must have been rebuilt with state.positions.
+# preferredVelocities overrides those of state, passing state.velocities leaves out the relaxation term.
+# With an obstacle map the wall forces are looked up in it instead of the corridor walls.
+def totalForces(state, grid, fluctuations, preferredVelocities=None):
+    if preferredVelocities is None:
+        preferredVelocities = state.preferredVelocities
+    forces = arrayTotalForces(state.positions, state.velocities, preferredVelocities, state.groups, fluctuations,
+                              state.boundaryMap, grid, state.obstacleMap is None)
+    if state.obstacleMap is not None:
+        forces += state.obstacleMap.wallForces(state.positions)
+    return forces
+
+# Same as totalForces for agent arrays which need not belong to one PedsimState (e.g. the flattened replicas of an Ensemble)
+def arrayTotalForces(positions, velocities, preferredVelocities, groups, fluctuations, boundaryMap, grid, corridorWalls=True):
+    out = np.empty((len(positions), 2))
+    return compiledTotalForces()(positions, velocities, preferredVelocities, groups, fluctuations,
+                        float(np.size(boundaryMap, 0)-1), corridorWalls,
+                        int(grid.numCells[0]), int(grid.numCells[1]), grid.cellOfAgent, grid.sortedAgents, grid.cellStart, grid.cellCount, out)
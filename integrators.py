@@ -0,0 +1,90 @@
+import numpy as np
+from agent import RELAXATION
+
+# Integrators advance the positions and velocities of a PedsimState by state.dt given the forces
+# computed by a VectorizedEngine or a synchronous AgentEngine (engine.forces / engine.externalForces). After the step every
+# integrator applies the velocity constraints (engine.constrainVelocities) and the boundary and
+# goal handling (engine.finishStep) of the model. An adaptive integrator chooses state.dt itself.
+# The update of positions and velocities is timed as the 'integration' phase of engine.profiler.
+# Results are written into the arrays of the state in place, which may be views (e.g. of compact agent records).
+
+# The original scheme of Agent.update: v += a*dt with the old position, then x += v*dt with the new velocity
+class EulerIntegrator:
+    adaptive = False
+
+    def step(self, engine, state, pedsim):
+        accelerations = engine.forces(state)
+        start = engine.profiler.clock()
+        state.accelerations[:] = accelerations
+        state.velocities += accelerations * state.dt
+        engine.constrainVelocities(state)
+        state.positions += state.velocities * state.dt
+        engine.profiler.record('integration', start)
+        engine.finishStep(state, pedsim)
+
+# Semi-implicit Euler: the stiff relaxation term (preferredVelocity - velocity)/RELAXATION is taken at the new
+# velocity, all other forces at the old positions. This is stable for any dt, while the explicit scheme
+# oscillates once dt approaches RELAXATION.
+class SemiImplicitEulerIntegrator:
+    adaptive = False
+
+    def step(self, engine, state, pedsim, externalForces=None):
+        if externalForces is None:
+            externalForces = engine.externalForces(state)
+        forces = externalForces + engine.fluctuations(state)
+        start = engine.profiler.clock()
+        dt = state.dt
+        oldVelocities = np.copy(state.velocities)
+        state.velocities[:] = (oldVelocities + dt*(state.preferredVelocities/RELAXATION + forces))/(1.0 + dt/RELAXATION)
+        state.accelerations[:] = (state.velocities - oldVelocities)/dt if dt > 0 else forces
+        engine.constrainVelocities(state)
+        state.positions += state.velocities * dt
+        engine.profiler.record('integration', start)
+        engine.finishStep(state, pedsim)
+
+# Velocity Verlet: positions use the acceleration of the previous step, velocities the average of the old
+# and the new acceleration (the new one evaluated at the half step velocity since forces depend on velocity)
+class VelocityVerletIntegrator:
+    adaptive = False
+
+    def step(self, engine, state, pedsim):
+        dt = state.dt
+        if state.nTimesteps == 0:
+            state.accelerations[:] = engine.forces(state)
+        start = engine.profiler.clock()
+        state.positions += state.velocities*dt + 0.5*state.accelerations*dt*dt
+        state.velocities += 0.5*state.accelerations*dt
+        engine.profiler.record('integration', start)
+        state.accelerations[:] = engine.forces(state)
+        start = engine.profiler.clock()
+        state.velocities += 0.5*state.accelerations*dt
+        engine.constrainVelocities(state)
+        engine.profiler.record('integration', start)
+        engine.finishStep(state, pedsim)
+
+# Semi-implicit Euler with a time step chosen every step from the largest deterministic acceleration
+# (relaxation plus wall and interaction forces, without the fluctuation), so the position error of a step
+# 0.5*|a|*dt^2 stays below tolerance. dt is kept within [dtMin, dtMax]: crowds near equilibrium take steps
+# up to dtMax while close encounters shrink it. The dt of every step ends up in state.time, state.dtMin and state.dtMax.
+class AdaptiveIntegrator:
+    adaptive = True
+
+    def __init__(self, tolerance=1e-3, dtMin=1e-4, dtMax=0.1):
+        self.tolerance = tolerance
+        self.dtMin = dtMin
+        self.dtMax = dtMax
+        self.semiImplicit = SemiImplicitEulerIntegrator()
+
+    def step(self, engine, state, pedsim):
+        externalForces = engine.externalForces(state)
+        start = engine.profiler.clock()
+        accelerations = (state.preferredVelocities - state.velocities)/RELAXATION + externalForces
+        maxAcceleration = np.sqrt(np.max(np.einsum('ij,ij->i', accelerations, accelerations))) if state.numAgents else 0.0
+        dt = self.dtMax
+        if maxAcceleration > 0:
+            dt = np.sqrt(2.0*self.tolerance/maxAcceleration)
+        state.dt = float(np.clip(dt, self.dtMin, self.dtMax))
+        engine.profiler.record('integration', start)
+        self.semiImplicit.step(engine, state, pedsim, externalForces)
+
+INTEGRATORS = {'euler': EulerIntegrator, 'semiimplicit': SemiImplicitEulerIntegrator, 'verlet': VelocityVerletIntegrator, 'adaptive': AdaptiveIntegrator}
@@ -0,0 +1,85 @@
+import numpy as np
+
+# Efficiency and discomfort measures of a run, computed from running sums kept in the agent arrays
+# of a PedsimState (cumSpeed, cumVelocity, cumSpeedPreferred, cumSpeedSquared). Every step costs a few
+# batched operations over all agents and no per-step history is kept. Each step is weighted by its
+# time step state.lastDt, so runs with a variable time step give proper time averages.
+#
+# Efficiency of an agent is its mean speed along the preferred direction over its preferred speed,
+# discomfort is 1 - |mean velocity|^2 / mean squared speed. Both are averaged over agents.
+
+# Adds the current velocities of all agents to the running sums
+# (and to the exponentially weighted window sums if startWindow was called)
+def accumulate(state):
+    dt = state.lastDt
+    velocities = state.velocities
+    speedsSquared = np.einsum('ij,ij->i', velocities, velocities)
+    speedsPreferred = np.einsum('ij,ij->i', velocities, state.preferredVelocities)/state.preferredSpeeds
+    state.cumSpeed += dt*np.sqrt(speedsSquared)
+    state.cumVelocity += dt*velocities
+    state.cumSpeedPreferred += dt*speedsPreferred
+    state.cumSpeedSquared += dt*speedsSquared
+    state.measuredTime += dt
+    if state.windowWeight is not None:
+        alpha = 1.0 - np.exp(-dt/state.windowTime)
+        state.windowWeight += alpha*(1.0 - state.windowWeight)
+        state.windowVelocity += alpha*(velocities - state.windowVelocity)
+        state.windowSpeedPreferred += alpha*(speedsPreferred - state.windowSpeedPreferred)
+        state.windowSpeedSquared += alpha*(speedsSquared - state.windowSpeedSquared)
+
+# [efficiency, discomfort] from per-agent time averages, over the agents selected by mask (default all)
+def _reduce(meanVelocity, meanSpeedPreferred, meanSpeedSquared, preferredSpeeds, mask):
+    if mask is not None:
+        meanVelocity = meanVelocity[mask]
+        meanSpeedPreferred = meanSpeedPreferred[mask]
+        meanSpeedSquared = meanSpeedSquared[mask]
+        preferredSpeeds = preferredSpeeds[mask]
+    efficiency = np.mean(meanSpeedPreferred/preferredSpeeds)
+    discomfort = np.mean(1 - np.einsum('ij,ij->i', meanVelocity, meanVelocity)/meanSpeedSquared)
+    return efficiency, discomfort
+
+# Efficiency and discomfort of the whole run so far
+def measures(state, mask=None):
+    n = state.measuredTime
+    return _reduce(state.cumVelocity/n, state.cumSpeedPreferred/n, state.cumSpeedSquared/n, state.preferredSpeeds, mask)
+
+# {group: (efficiency, discomfort)} of the whole run so far
+def groupMeasures(state):
+    return dict((int(group), measures(state, state.groups == group)) for group in np.unique(state.groups))
+
+# State arrays of the window averages, one row per agent like the other agent arrays
+WINDOW_ARRAYS = ['windowWeight', 'windowVelocity', 'windowSpeedPreferred', 'windowSpeedSquared']
+
+# Makes accumulate also keep exponentially weighted averages with a time constant of windowTime (simulated time),
+# so windowedMeasures reports the measures of roughly the last windowTime in O(numAgents) memory.
+# Every agent has its own weight, an agent added later (see openboundary.py) starts from a zero row.
+def startWindow(state, windowTime):
+    state.windowTime = windowTime
+    state.windowWeight = np.zeros(state.numAgents)
+    state.windowVelocity = np.zeros((state.numAgents, 2))
+    state.windowSpeedPreferred = np.zeros(state.numAgents)
+    state.windowSpeedSquared = np.zeros(state.numAgents)
+
+# Efficiency and discomfort over the recent window (see startWindow), of the agents selected by mask which have been measured
+def windowedMeasures(state, mask=None):
+    measured = state.windowWeight > 0
+    if mask is not None:
+        measured &= mask
+    w = state.windowWeight[measured]
+    return _reduce(state.windowVelocity[measured]/w[:, np.newaxis], state.windowSpeedPreferred[measured]/w,
+                   state.windowSpeedSquared[measured]/w, state.preferredSpeeds[measured], None)
+
+# Two-sided 95% quantiles of Student's t distribution for 1..30 degrees of freedom
+T_QUANTILES_95 = [12.706, 4.303, 3.182, 2.776, 2.571, 2.447, 2.365, 2.306, 2.262, 2.228,
+                  2.201, 2.179, 2.160, 2.145, 2.131, 2.120, 2.110, 2.101, 2.093, 2.086,
+                  2.080, 2.074, 2.069, 2.064, 2.060, 2.056, 2.052, 2.048, 2.045, 2.042]
+
+# Mean and half width of the 95% confidence interval of the mean of values (e.g. one measure over repetitions).
+# The half width is inf for fewer than two values.
+def confidenceInterval(values):
+    values = np.asarray(values, dtype=float)
+    n = len(values)
+    if n < 2:
+        return np.mean(values), np.inf
+    t = T_QUANTILES_95[n-2] if n-1 <= len(T_QUANTILES_95) else 1.960
+    return np.mean(values), t*np.std(values, ddof=1)/np.sqrt(n)
@@ -0,0 +1,86 @@
+import numpy as np
+import heapq
+from obstaclemap import ObstacleMap
+
+# Goal-directed navigation by precomputed flow fields. For every goal set the walking distance to the goal
+# is computed once with Dijkstra's algorithm on a grid over the map (8 neighbours, nodes closer than clearance
+# to a wall or obstacle are blocked), and the direction of steepest descent of that distance is stored per node.
+# During a run the preferred direction of every agent is a bilinear lookup in the field of its goal,
+# which costs the same per step whatever the shape of the map.
+
+# Walking distance from every node of a grid with spacing resolution to the closest goal node,
+# passable and goal are boolean (numNodesX, numNodesY) arrays. Blocked and unreachable nodes are inf.
+def goalDistances(passable, goal, resolution):
+    numNodesX, numNodesY = np.shape(passable)
+    distances = np.full((numNodesX, numNodesY), np.inf)
+    heap = []
+    for (i, j) in zip(*np.nonzero(goal & passable)):
+        distances[i, j] = 0.0
+        heap.append((0.0, int(i), int(j)))
+    heapq.heapify(heap)
+    DIAGONAL = np.sqrt(2.0)*resolution
+    neighbors = [(-1, 0, resolution), (1, 0, resolution), (0, -1, resolution), (0, 1, resolution),
+                 (-1, -1, DIAGONAL), (-1, 1, DIAGONAL), (1, -1, DIAGONAL), (1, 1, DIAGONAL)]
+    while heap:
+        distance, i, j = heapq.heappop(heap)
+        if distance > distances[i, j]:
+            continue
+        for (di, dj, length) in neighbors:
+            ni = i + di
+            nj = j + dj
+            if 0 <= ni < numNodesX and 0 <= nj < numNodesY and passable[ni, nj] and distance + length < distances[ni, nj]:
+                distances[ni, nj] = distance + length
+                heapq.heappush(heap, (distance + length, ni, nj))
+    return distances
+
+# Unit direction towards one goal set at every node of a grid with spacing resolution, from the goal distances of the nodes.
+# Nodes without a direction (inside the goal, blocked or unreachable) get defaultDirection.
+class FlowField:
+    def __init__(self, resolution, distances, defaultDirection):
+        self.resolution = resolution
+        self.distances = distances
+        # Blocked nodes count as further away than any reachable node, so the field points away from walls next to them
+        finite = np.isfinite(distances)
+        padded = np.where(finite, distances, (distances[finite].max() if finite.any() else 0.0) + resolution)
+        gradientX, gradientY = np.gradient(padded, resolution)
+        norms = np.sqrt(gradientX**2 + gradientY**2)
+        hasDirection = finite & (norms > 0) & (distances > 0)
+        self.directions = np.empty(np.shape(distances) + (2,))
+        self.directions[:] = defaultDirection
+        self.directions[hasDirection, 0] = -gradientX[hasDirection]/norms[hasDirection]
+        self.directions[hasDirection, 1] = -gradientY[hasDirection]/norms[hasDirection]
+
+# Flow fields of both groups of the corridor scenario, used as the attractors of a PedsimState:
+# group 0 walks to the region right of goalLineRight and group 1 to the region left of goalLineLeft,
+# around whatever walls and obstacles the obstacle map has. Agents beyond their goal line keep walking
+# straight on (+x or -x) as without navigation.
+class FlowFieldNavigation:
+    def __init__(self, boundaryMap, obstacleMap, goalLineLeft, goalLineRight, resolution=0.1, clearance=0.3):
+        if obstacleMap is None:
+            obstacleMap = ObstacleMap.fromBoundaryMap(boundaryMap)
+        length = np.size(boundaryMap, 1)-1
+        width = np.size(boundaryMap, 0)-1
+        xs = resolution*np.arange(int(np.ceil(length/resolution)) + 1)
+        ys = resolution*np.arange(int(np.ceil(width/resolution)) + 1)
+        nodes = np.stack(np.meshgrid(xs, ys, indexing='ij'), -1)
+        passable = obstacleMap.distance(nodes.reshape(-1, 2)).reshape(len(xs), len(ys)) > clearance
+        self.resolution = resolution
+        self.fields = [FlowField(resolution, goalDistances(passable, nodes[:, :, 0] >= goalLineRight, resolution), (1.0, 0.0)),
+                       FlowField(resolution, goalDistances(passable, nodes[:, :, 0] <= goalLineLeft, resolution), (-1.0, 0.0))]
+        # Directions of all groups as one (numGroups, numNodesX, numNodesY, 2) array, so all agents are looked up at once
+        self.directions = np.stack([field.directions for field in self.fields])
+        self.numNodes = np.array([len(xs), len(ys)])
+
+    # Unit preferred direction of every agent in the field of its group, bilinearly interpolated, (numAgents, 2)
+    def preferredDirections(self, positions, groups):
+        u = np.clip(positions[:, 0]/self.resolution, 0, self.numNodes[0]-1.000001)
+        v = np.clip(positions[:, 1]/self.resolution, 0, self.numNodes[1]-1.000001)
+        i = u.astype(int)
+        j = v.astype(int)
+        fu = (u - i)[:, np.newaxis]
+        fv = (v - j)[:, np.newaxis]
+        d = self.directions
+        directions = (d[groups, i, j]*(1-fu) + d[groups, i+1, j]*fu)*(1-fv) + (d[groups, i, j+1]*(1-fu) + d[groups, i+1, j+1]*fu)*fv
+        norms = np.sqrt(np.einsum('ij,ij->i', directions, directions))
+        norms[norms == 0] = 1.0
+        return directions/norms[:, np.newaxis]
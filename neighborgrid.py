@@ -0,0 +1,78 @@
+import numpy as np
+
+# Uniform grid (cell list) used to find all pairs of agents closer than a cutoff.
+# Cells are cutoff wide so every neighbor of an agent lies in the 3x3 block of cells around it.
+# The grid covers the boundary map and grows to cover agents outside of it (e.g. past the goal lines).
+# Agents are sorted by cell once per step, after that the candidate pairs
+# of all agents are generated with a few repeat/arange operations and no Python loop over agents.
+class NeighborGrid:
+    def __init__(self, cutoff):
+        self.cutoff = cutoff
+        self.cellSize = cutoff
+        self.origin = None
+        self.numCells = None
+        self.cellOfAgent = None
+        self.sortedAgents = None
+        self.cellStart = None
+        self.cellCount = None
+
+    # Sorts agents into cells, must be called whenever positions have changed
+    def rebuild(self, positions, boundaryMap):
+        origin, numCells = self.extent(positions, boundaryMap)
+        self.rebuildOn(positions, origin, numCells)
+
+    # Origin and number of cells of the grid covering the boundary map and all positions
+    def extent(self, positions, boundaryMap):
+        lower = np.array([0.0, 0.0])
+        upper = np.array([np.size(boundaryMap, 1)-1, np.size(boundaryMap, 0)-1], dtype=float)
+        if len(positions):
+            lower = np.minimum(lower, positions.min(0))
+            upper = np.maximum(upper, positions.max(0))
+        return lower, np.floor((upper - lower)/self.cellSize).astype(int) + 1
+
+    # Same as rebuild on a given grid, which must cover all positions. A subset of the agents sorted into the grid
+    # of all agents (same origin and numCells) is visited in the same order, see domaindecomposition.py
+    def rebuildOn(self, positions, origin, numCells):
+        self.origin = origin
+        self.sortInto(np.floor((positions - self.origin)/self.cellSize).astype(int), numCells)
+
+    # Sorts agents into the given (x, y) cells of a grid of numCells cells. Lets several grids share one cell list,
+    # e.g. the replicas of an Ensemble each on its own grid. origin is then not used by pairs and the force kernel.
+    def sortInto(self, cells, numCells):
+        self.numCells = numCells
+        self.cellOfAgent = cells[:, 0]*self.numCells[1] + cells[:, 1]
+        self.sortedAgents = np.argsort(self.cellOfAgent, kind='stable')
+        self.cellCount = np.bincount(self.cellOfAgent, minlength=self.numCells[0]*self.numCells[1])
+        self.cellStart = np.cumsum(self.cellCount) - self.cellCount
+
+    # Returns index arrays (i, j) of every ordered pair i != j closer than cutoff, so each
+    # unordered pair appears twice. Must be called after rebuild with the same positions.
+    def pairs(self, positions):
+        numAgents = len(positions)
+        agents = np.arange(numAgents)
+        cellX = self.cellOfAgent // self.numCells[1]
+        cellY = self.cellOfAgent % self.numCells[1]
+        iParts = []
+        jParts = []
+        for offsetX in (-1, 0, 1):
+            for offsetY in (-1, 0, 1):
+                neighborX = cellX + offsetX
+                neighborY = cellY + offsetY
+                valid = (neighborX >= 0) & (neighborX < self.numCells[0]) & (neighborY >= 0) & (neighborY < self.numCells[1])
+                neighborCell = (neighborX*self.numCells[1] + neighborY)[valid]
+                counts = self.cellCount[neighborCell]
+                total = counts.sum()
+                if total == 0:
+                    continue
+                i = np.repeat(agents[valid], counts)
+                offsetInCell = np.arange(total) - np.repeat(np.cumsum(counts) - counts, counts)
+                j = self.sortedAgents[np.repeat(self.cellStart[neighborCell], counts) + offsetInCell]
+                iParts.append(i)
+                jParts.append(j)
+        if not iParts:
+            return np.zeros(0, dtype=int), np.zeros(0, dtype=int)
+        i = np.concatenate(iParts)
+        j = np.concatenate(jParts)
+        rab = positions[i] - positions[j]
+        close = (i != j) & (np.einsum('ij,ij->i', rab, rab) < self.cutoff**2)
+        return i[close], j[close]
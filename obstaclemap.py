@@ -0,0 +1,123 @@
+import numpy as np
+import json
+from agent import WALL_SCALAR, WALL_WIDTH
+
+# Obstacle map of walls (line segments) and solid obstacles (polygons) in a length x width area,
+# x along the corridor in [0, length] and y across it in [0, width], the same frame as a boundary map with
+# width+1 rows and length+1 columns. The signed distance to the closest wall or obstacle edge (negative
+# inside polygons) and its gradient are computed once on a grid of spacing resolution covering the map
+# and a margin of padding around it. Afterwards the wall force on any number of agents is a bilinear
+# lookup, so a map with many obstacles costs the same per step as the straight corridor.
+#
+# Map files are JSON, e.g. a corridor with a pillar:
+# {"length": 30, "width": 6, "resolution": 0.05,
+#  "segments": [[[-2, 0], [32, 0]], [[-2, 6], [32, 6]]],
+#  "polygons": [[[14, 2], [16, 2], [16, 4], [14, 4]]]}
+# Lookups outside the grid take the value at its edge, so walls running out of the map should extend past it.
+class ObstacleMap:
+    def __init__(self, length, width, segments=(), polygons=(), resolution=0.05, padding=1.0):
+        self.length = float(length)
+        self.width = float(width)
+        self.resolution = float(resolution)
+        self.segments = np.array(segments, dtype=float).reshape(-1, 2, 2)
+        self.polygons = [np.array(polygon, dtype=float).reshape(-1, 2) for polygon in polygons]
+        self.origin = np.array([-padding, -padding])
+        self.numNodes = (np.ceil((np.array([self.length, self.width]) + 2*padding)/self.resolution).astype(int) + 1)
+        xs = self.origin[0] + self.resolution*np.arange(self.numNodes[0])
+        ys = self.origin[1] + self.resolution*np.arange(self.numNodes[1])
+        nodes = np.stack(np.meshgrid(xs, ys, indexing='ij'), -1).reshape(-1, 2)
+        distances = self.exactDistance(nodes).reshape(self.numNodes)
+        gradientX, gradientY = np.gradient(distances, self.resolution)
+        # Distance and gradient at each node, (numNodesX, numNodesY, 3), so a lookup gathers all three at once
+        self.fields = np.stack((distances, gradientX, gradientY), -1)
+
+    @staticmethod
+    def load(path):
+        with open(path) as f:
+            description = json.load(f)
+        return ObstacleMap(description['length'], description['width'], description.get('segments', []),
+                           description.get('polygons', []), description.get('resolution', 0.05), description.get('padding', 1.0))
+
+    # The straight corridor of a boolean boundary map such as Boundarymap.boundaryMap1, walls on its first and last row
+    @staticmethod
+    def fromBoundaryMap(boundaryMap, resolution=0.05, padding=1.0):
+        length = np.size(boundaryMap, 1)-1
+        width = np.size(boundaryMap, 0)-1
+        segments = [[[-2*padding, 0], [length + 2*padding, 0]], [[-2*padding, width], [length + 2*padding, width]]]
+        return ObstacleMap(length, width, segments, [], resolution, padding)
+
+    # Edges of all walls and polygons as a (numEdges, 2, 2) array of end points
+    def edges(self):
+        edges = [self.segments]
+        for polygon in self.polygons:
+            edges.append(np.stack((polygon, np.roll(polygon, -1, 0)), 1))
+        return np.concatenate(edges)
+
+    # Signed distance of points to the closest edge, negative inside polygons, computed exactly (used to build the grid)
+    def exactDistance(self, points):
+        distances = np.full(len(points), np.inf)
+        for (start, end) in self.edges():
+            direction = end - start
+            lengthSquared = np.dot(direction, direction)
+            t = np.zeros(len(points)) if lengthSquared == 0 else np.clip(np.dot(points - start, direction)/lengthSquared, 0.0, 1.0)
+            closest = start + t[:, np.newaxis]*direction
+            np.minimum(distances, np.sqrt(np.einsum('ij,ij->i', points - closest, points - closest)), out=distances)
+        inside = np.zeros(len(points), dtype=bool)
+        for polygon in self.polygons:
+            inside ^= self.contains(polygon, points)
+        distances[inside] *= -1
+        return distances
+
+    # Even-odd rule point in polygon test for all points at once
+    @staticmethod
+    def contains(polygon, points):
+        inside = np.zeros(len(points), dtype=bool)
+        x = points[:, 0]
+        y = points[:, 1]
+        for (x1, y1), (x2, y2) in zip(polygon, np.roll(polygon, -1, 0)):
+            crosses = (y1 > y) != (y2 > y)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                xCross = x1 + (y - y1)*(x2 - x1)/(y2 - y1)
+            inside ^= crosses & (x < xCross)
+        return inside
+
+    # Bilinear interpolation of the distance and its gradient at positions, (numAgents, 3)
+    def lookup(self, positions):
+        u = np.clip((positions[:, 0] - self.origin[0])/self.resolution, 0, self.numNodes[0]-1.000001)
+        v = np.clip((positions[:, 1] - self.origin[1])/self.resolution, 0, self.numNodes[1]-1.000001)
+        i = u.astype(int)
+        j = v.astype(int)
+        fu = (u - i)[:, np.newaxis]
+        fv = (v - j)[:, np.newaxis]
+        fields = self.fields
+        return (fields[i, j]*(1-fu) + fields[i+1, j]*fu)*(1-fv) + (fields[i, j+1]*(1-fu) + fields[i+1, j+1]*fu)*fv
+
+    def distance(self, positions):
+        return self.lookup(positions)[:, 0]
+
+    # Exponential wall repulsion of the corridor model exp(WALL_SCALAR/d) - 1 for the distance d to the closest
+    # edge, along the distance gradient. The gradient vanishes where two walls are equally close, as do their forces.
+    def wallForces(self, positions):
+        values = self.lookup(positions)
+        magnitude = np.exp(WALL_SCALAR/np.maximum(values[:, 0], WALL_WIDTH)) - 1.0
+        return magnitude[:, np.newaxis]*values[:, 1:3]
+
+    # Moves agents closer than WALL_WIDTH to an edge (or inside an obstacle) back out along the gradient, in place
+    def confine(self, positions):
+        values = self.lookup(positions)
+        tooClose = values[:, 0] < WALL_WIDTH
+        if not tooClose.any():
+            return
+        gradients = values[tooClose, 1:3]
+        norms = np.sqrt(np.einsum('ij,ij->i', gradients, gradients))
+        norms[norms == 0] = 1.0
+        positions[tooClose] += ((WALL_WIDTH - values[tooClose, 0])/norms)[:, np.newaxis]*gradients
+
+    # Boolean boundary map of the obstacle map, True at integer nodes within half a meter of an edge or inside an obstacle.
+    # It has width+1 rows and length+1 columns, so code that reads the size of the corridor from a boundary map still works.
+    def boundaryMap(self):
+        rows = int(np.ceil(self.width)) + 1
+        columns = int(np.ceil(self.length)) + 1
+        ys, xs = np.meshgrid(np.arange(rows), np.arange(columns), indexing='ij')
+        nodes = np.column_stack((xs.ravel(), ys.ravel())).astype(float)
+        return (self.exactDistance(nodes) <= 0.5).reshape(rows, columns)
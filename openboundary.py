@@ -0,0 +1,178 @@
+import numpy as np
+from agent import AgentSequence
+from metrics import WINDOW_ARRAYS
+
+# Open boundary scenario: agents enter the corridor at Poisson distributed times at the entrance of their group
+# (group 0 at the left end, group 1 at the right end) and leave it when they cross their goal line.
+# The agent arrays of the PedsimState are allocated once with numAgents rows and used as a pool: the active
+# agents always occupy the first rows and the free list is the tail, so arriving agents take the first free row
+# and leaving agents are removed by moving the remaining ones up (through preallocated scratch rows). The state's arrays
+# are views onto the active rows and state.agents an AgentSequence bounded by the number of active agents, so the
+# engines, metrics and visualizer work on them unchanged and nothing is allocated as agents come and go.
+# Arrivals which find the pool full or their entrance occupied wait in a queue (a counter per entrance).
+#
+# Measured after warmupTime simulated seconds: flow rate (agents leaving per second), mean density between the goal
+# lines (agents per square meter) and efficiency and discomfort of every agent that left, over its own time in the corridor.
+class OpenBoundary:
+    POOL_ARRAYS = ['positions', 'positions0', 'velocities', 'preferredVelocities', 'accelerations', 'groups', 'inGoal',
+                   'goalCounts', 'preferredSpeeds', 'cumVelocity', 'cumSpeed', 'cumSpeedPreferred', 'cumSpeedSquared']
+    MIN_SPEED = 0.2
+    SPAWN_CLEARANCE = 0.6 # Smallest distance of an arriving agent to any other agent or wall
+    ENTRANCE_DEPTH = 1.0 # Length of the strip along the corridor where agents arrive
+
+    def __init__(self, state, inflowRates, warmupTime=0.0):
+        self.inflowRates = np.array(inflowRates, dtype=float)
+        self.warmupTime = warmupTime
+        self.capacity = state.numAgents
+        # The window averages of metrics.startWindow, if started, are pooled like the other agent arrays
+        self.poolArrays = self.POOL_ARRAYS + (WINDOW_ARRAYS if state.windowWeight is not None else [])
+        self.pool = dict((name, getattr(state, name)) for name in self.poolArrays)
+        self.scratch = dict((name, np.empty_like(self.pool[name])) for name in self.poolArrays)
+        if not isinstance(state.agents, AgentSequence):
+            state.agents = AgentSequence(state, state.agents)
+        self.leaving = np.zeros(self.capacity, dtype=bool)
+        self.keep = np.zeros(self.capacity, dtype=bool)
+        self.spawnTimes = np.zeros(self.capacity)
+        self.scratch['spawnTimes'] = np.empty_like(self.spawnTimes)
+        self.numActive = 0
+        self.queued = np.zeros(len(self.inflowRates), dtype=np.int64)
+
+        margin = 1
+        bmshape = np.shape(state.boundaryMap)
+        self.yRange = (margin, bmshape[0]-1-margin)
+        self.entrances = [(margin, margin+self.ENTRANCE_DEPTH), (bmshape[1]-1-margin-self.ENTRANCE_DEPTH, bmshape[1]-1-margin)]
+        self.measureArea = (state.goalLineRight - state.goalLineLeft)*(bmshape[0]-1)
+
+        self.measuredTime = 0.0
+        self.numLeft = np.zeros(len(self.inflowRates), dtype=np.int64)
+        self.numArrived = np.zeros(len(self.inflowRates), dtype=np.int64)
+        self.agentSeconds = 0.0 # Integral over time of the number of agents between the goal lines
+        self.sumEfficiency = 0.0
+        self.sumDiscomfort = 0.0
+        self.numMeasured = 0
+        self.resize(state, 0)
+
+    # Scratch rows are not saved with snapshots
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['scratch']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.scratch = dict((name, np.empty_like(self.pool[name])) for name in self.poolArrays)
+        self.scratch['spawnTimes'] = np.empty_like(self.spawnTimes)
+
+    # Points the arrays of state at the first numActive rows of the pool
+    def resize(self, state, numActive):
+        self.numActive = numActive
+        for name in self.poolArrays:
+            setattr(state, name, self.pool[name][:numActive])
+        state.numAgents = numActive
+
+    # Copies arrays the engine has replaced instead of updating in place (e.g. state.accelerations) back into the pool
+    def gather(self, state):
+        for name in self.poolArrays:
+            array = getattr(state, name)
+            if not np.shares_memory(array, self.pool[name]):
+                self.pool[name][:self.numActive] = array
+
+    # Called after every step: removes agents which crossed their goal line, lets queued and new agents in and updates the measures
+    def step(self, state):
+        self.gather(state)
+        measuring = state.time > self.warmupTime
+        leaving = self.leaving[:self.numActive]
+        np.copyto(leaving, state.inGoal)
+        if leaving.any():
+            if measuring:
+                self.measureLeaving(state, leaving)
+            keep = self.keep[:self.numActive]
+            np.logical_not(leaving, out=keep)
+            self.remove(state, keep)
+        self.queued += state.rng.poisson(self.inflowRates*state.lastDt)
+        for group in range(len(self.inflowRates)):
+            self.admit(state, group)
+        if measuring:
+            self.measuredTime += state.lastDt
+            x = state.positions[:, 0]
+            self.agentSeconds += state.lastDt*np.count_nonzero((x > state.goalLineLeft) & (x < state.goalLineRight))
+
+    def measureLeaving(self, state, leaving):
+        lifetimes = state.time - self.spawnTimes[:self.numActive][leaving]
+        valid = (lifetimes > 0) & (state.cumSpeedSquared[leaving] > 0)
+        lifetimes = lifetimes[valid]
+        meanVelocity = state.cumVelocity[leaving][valid]/lifetimes[:, np.newaxis]
+        meanSpeedPreferred = state.cumSpeedPreferred[leaving][valid]/lifetimes
+        meanSpeedSquared = state.cumSpeedSquared[leaving][valid]/lifetimes
+        self.sumEfficiency += np.sum(meanSpeedPreferred/state.preferredSpeeds[leaving][valid])
+        self.sumDiscomfort += np.sum(1 - np.einsum('ij,ij->i', meanVelocity, meanVelocity)/meanSpeedSquared)
+        self.numMeasured += int(np.count_nonzero(valid))
+        self.numLeft += np.bincount(state.groups[leaving], minlength=len(self.numLeft))
+
+    # Keeps the active agents selected by keep, moved up to the first rows of the pool in their order
+    def remove(self, state, keep):
+        numKeep = int(np.count_nonzero(keep))
+        for name in self.poolArrays:
+            self.compact(self.pool[name], self.scratch[name], keep, numKeep)
+        self.compact(self.spawnTimes, self.scratch['spawnTimes'], keep, numKeep)
+        self.resize(state, numKeep)
+
+    def compact(self, array, scratch, keep, numKeep):
+        np.compress(keep, array[:self.numActive], axis=0, out=scratch[:numKeep])
+        array[:numKeep] = scratch[:numKeep]
+
+    # Lets queued agents of group in, one at a time while the pool has room and a random spot in the entrance is clear
+    def admit(self, state, group):
+        while self.queued[group] > 0 and self.numActive < self.capacity:
+            xMin, xMax = self.entrances[group]
+            position = np.array([state.rng.uniform(xMin, xMax), state.rng.uniform(*self.yRange)])
+            positions = self.pool['positions'][:self.numActive]
+            if len(positions):
+                offsets = positions - position
+                if np.min(np.einsum('ij,ij->i', offsets, offsets)) < self.SPAWN_CLEARANCE**2:
+                    return
+            if state.obstacleMap is not None and state.obstacleMap.distance(position[np.newaxis, :])[0] < self.SPAWN_CLEARANCE:
+                return
+            self.spawn(state, group, position)
+            self.queued[group] -= 1
+
+    def spawn(self, state, group, position):
+        i = self.numActive
+        pool = self.pool
+        speed = max(self.MIN_SPEED, state.rng.normal(state.mean, state.variance))
+        pool['positions'][i] = position
+        pool['positions0'][i] = position
+        pool['groups'][i] = group
+        pool['preferredSpeeds'][i] = speed
+        pool['preferredVelocities'][i] = [speed if group == 0 else -speed, 0.0]
+        pool['velocities'][i] = pool['preferredVelocities'][i]
+        pool['accelerations'][i] = 0.0
+        pool['inGoal'][i] = False
+        pool['goalCounts'][i] = 0
+        pool['cumVelocity'][i] = 0.0
+        pool['cumSpeed'][i] = 0.0
+        pool['cumSpeedPreferred'][i] = 0.0
+        pool['cumSpeedSquared'][i] = 0.0
+        for name in self.poolArrays[len(self.POOL_ARRAYS):]:
+            pool[name][i] = 0.0
+        self.spawnTimes[i] = state.time
+        self.numArrived[group] += 1
+        self.resize(state, i + 1)
+
+    # Agents leaving per second, in total and per group, over the measured time
+    def flowRates(self):
+        if self.measuredTime == 0:
+            return 0.0, np.zeros(len(self.numLeft))
+        return self.numLeft.sum()/self.measuredTime, self.numLeft/self.measuredTime
+
+    # Mean number of agents per square meter between the goal lines over the measured time
+    def density(self):
+        if self.measuredTime == 0:
+            return 0.0
+        return self.agentSeconds/self.measuredTime/self.measureArea
+
+    # [efficiency, discomfort] averaged over all agents which left during the measured time
+    def measures(self):
+        if self.numMeasured == 0:
+            return [np.nan, np.nan]
+        return [self.sumEfficiency/self.numMeasured, self.sumDiscomfort/self.numMeasured]
@@ -1,23 +1,35 @@
 import numpy as np
 import time
 import argparse
-import pyqtgraph as pg
-from pyqtgraph.Qt import QtGui, QtCore
 import warnings
-warnings.filterwarnings("ignore", category=np.VisibleDeprecationWarning)
-from pedsimvisualizer import PedsimVisualizer
 from pedsimstate import PedsimState
+from pedsimengine import ENGINES, NEIGHBOR_SEARCHES, KERNELS, INTEGRATORS
 from Boundarymap import *
 import pickle
+import concurrent.futures
+import collections
+import os
+from resultstore import ResultStore
+from trajectoryrecorder import TrajectoryRecorder
+from ensemble import Ensemble
+from phaseprofiler import PhaseProfiler, NULL_PROFILER
+from obstaclemap import ObstacleMap
+from navigation import FlowFieldNavigation
+from openboundary import OpenBoundary
+from adaptivesweep import AdaptiveSweep
+from runcontroller import RunController, GOAL, QUIT
+import metrics
 
 # PROTIP: 
 # python -m cProfile -s cumtime pedsim.py --disableplotting -n 100 -mu 1 -sigma 1 -dt 0.03 > profile.txt
 # dt < 0.03 for no oscillation
+# For the time of each phase of a step without the overhead of cProfile:
+# python pedsim.py --disableplotting -n 100 -mu 1 -sigma 1 --profile -profileoutput profile.json
 
 # The Pedestrian simulator Pedsim have PedsimState(s) which Pedsim can update
 # and a visualizer which can visualize the state
 class Pedsim:   
-    def __init__(self, numAgents, plotdirections, plotaccelerations, plotRefreshRate, dt, mus, sigmas, enablePlotting, continuous, useGrid, enableSaving, numAverages, boundaryMap):
+    def __init__(self, numAgents, plotdirections, plotaccelerations, plotRefreshRate, dt, mus, sigmas, enablePlotting, continuous, useGrid, enableSaving, numAverages, boundaryMap, engine='vectorized', neighborSearch='grid', workers=1, seed=None, resultPath='results.csv', resume=False, snapshotInterval=0, snapshotDir='snapshots', kernel='auto', recordDir=None, recordStride=1, integrator='euler', tolerance=1e-3, dtMax=0.1, ensembleSize=1, profile=False, profileOutput=None, obstacleMap=None, navigation=False, inflowRate=0.0, warmupTime=0.0, compact=False, adaptive=False, ciTolerance=0.02, refineThreshold=0.1, refinements=2, maxTime=0.0, stallTime=0.0, stallSpeed=0.05, steadyTolerance=0.0, steadyTime=10.0, synchronous=False, threads=1, slabs=1, groupMeasures=False, measureWindow=0.0):
         self.visualizer = None
 
         # If enablePlotting=False, do not plot at all. Dont even create a window.
@@ -37,30 +49,302 @@ class Pedsim:
         self.continuous = continuous
         self.enableSaving = enableSaving;
         self.boundaryMap = boundaryMap
+        # Walls and obstacles as an ObstacleMap (-map <file>), None for the straight corridor of boundaryMap
+        self.obstacleMap = obstacleMap
+        # Steer agents along flow fields to their goal (built on first use, see navigation.py) instead of walking straight along x
+        self.navigation = navigation
+        self.flowFields = None
+        # Open boundary: agents arrive at each entrance at inflowRate per second and leave at their goal line,
+        # numAgents is then the most agents present at once. Flow rate and density are measured after warmupTime.
+        self.inflowRate = inflowRate
+        self.warmupTime = warmupTime
+        if(inflowRate > 0 and continuous):
+            warnings.warn("agents leave at their goal line with an open boundary, ignoring continuous")
+            self.continuous = False
+        # Keep agent data in float32 structured arrays without Agent objects, for very large crowds (see PedsimState)
+        self.compact = compact
+        # Adaptive sweep (see adaptivesweep.py): repeat a point only until the 95% confidence intervals of its measures are
+        # within +- ciTolerance (at most numAverages times) and refine cells whose measures differ by more than refineThreshold
+        self.adaptive = adaptive
+        self.ciTolerance = ciTolerance
+        self.refineThreshold = refineThreshold
+        self.refinements = refinements
+        if(adaptive and not enableSaving):
+            warnings.warn("the adaptive sweep is steered by the measures of each run, which need --save, running a uniform sweep")
+            self.adaptive = False
+        # Besides reaching its goal count a run ends after maxTime simulated seconds, when its mean speed over the last stallTime
+        # seconds is below stallSpeed times the preferred speed, or when its measures stay within steadyTolerance for steadyTime
+        # seconds (0 disables each, see runcontroller.py). The reason is stored with the result.
+        self.maxTime = maxTime
+        self.stallTime = stallTime
+        self.stallSpeed = stallSpeed
+        self.steadyTolerance = steadyTolerance
+        self.steadyTime = steadyTime
+        if(steadyTolerance > 0 and not enableSaving):
+            warnings.warn("steady state is detected from the measures of a run, which need --save, ignoring steadytolerance")
+            self.steadyTolerance = 0.0
+        # Every run also reports its measures per group and over its last measureWindow simulated seconds (0 disables, see metrics.py)
+        self.groupMeasures = groupMeasures
+        self.measureWindow = measureWindow
+        if((groupMeasures or measureWindow > 0) and not enableSaving):
+            warnings.warn("measures need --save, ignoring groupmeasures and window")
+            self.groupMeasures = False
+            self.measureWindow = 0.0
+        if(groupMeasures and inflowRate > 0):
+            warnings.warn("an open boundary measures the agents which left, not per group, ignoring groupmeasures")
+            self.groupMeasures = False
+        # Engine which advances a PedsimState one step, see pedsimengine.py
+        if(integrator == 'adaptive'):
+            self.integrator = INTEGRATORS[integrator](tolerance, min(1e-4, dtMax), dtMax)
+        else:
+            self.integrator = INTEGRATORS[integrator]()
+        # synchronous makes the agent engine evaluate all forces before moving any agent, threads splits the force phase
+        self.engine = ENGINES[engine](neighborSearch, kernel, self.integrator, synchronous, threads)
+        # slabs > 1 splits every step of a run over that many processes, see domaindecomposition.py
+        if(slabs > 1 and (engine != 'vectorized' or neighborSearch != 'grid')):
+            warnings.warn("domain decomposition needs the vectorized engine with grid neighbor search, ignoring slabs")
+        elif(slabs > 1):
+            from domaindecomposition import DecomposedEngine
+            self.engine = DecomposedEngine(neighborSearch, kernel, self.integrator, slabs)
+            if(workers > 1):
+                warnings.warn("domain decomposition already runs on several processes, running sweep jobs one by one")
+                workers = 1
+        # Per-phase timing of every step (see phaseprofiler.py), reported at the end of run and written to profileOutput as JSON
+        self.profiler = PhaseProfiler() if profile else NULL_PROFILER
+        self.profileOutput = profileOutput
+        self.engine.profiler = self.profiler
+        # Number of sweep jobs stepped together as one Ensemble. An Ensemble only implements the vectorized update with
+        # the euler scheme and no per-run recording, snapshots or plotting, otherwise jobs are run one by one.
+        self.ensembleSize = ensembleSize
+        if(ensembleSize > 1 and (engine != 'vectorized' or integrator != 'euler' or recordDir is not None or snapshotInterval > 0 or enablePlotting or inflowRate > 0 or compact or slabs > 1 or self.measureWindow > 0)):
+            warnings.warn("ensemble mode needs the vectorized engine, the euler integrator and no recording, snapshots, plotting, open boundary, compact states, domain decomposition or window measures, running jobs one by one")
+            self.ensembleSize = 1
+        # Number of processes a sweep is spread over, plotting always runs in this process
+        self.workers = workers
+        # Master seed of a sweep (--seed), None draws a fresh one from the OS for every call to run
+        self.seed = seed
+        # Append-only store of finished jobs and whether jobs already in it (or in a snapshot) are skipped
+        self.resultPath = resultPath
+        self.resume = resume
+        # Save a snapshot of a running state every snapshotInterval steps into snapshotDir, 0 disables
+        self.snapshotInterval = snapshotInterval
+        self.snapshotDir = snapshotDir
+        # Stream every recordStride:th step of each run to a trajectory file in recordDir, None disables
+        self.recordDir = recordDir
+        self.recordStride = recordStride
         if(self.enablePlotting):
-            self.visualizer = PedsimVisualizer(plotdirections, plotaccelerations, plotRefreshRate, self.dt, enablePlotting, useGrid, self.boundaryMap)
+            # The window is drawn by a separate renderer process, see AsyncVisualizer. Qt and pyqtgraph are only
+            # imported here, so headless runs and sweep workers start without them (and without a display).
+            from pedsimvisualizer import AsyncVisualizer
+            self.visualizer = AsyncVisualizer(plotdirections, plotaccelerations, plotRefreshRate, self.dt, enablePlotting, useGrid, self.boundaryMap, self.numAgents, self.obstacleMap)
         
     # Advances the state to next iteration
     def simulate(self, state):
+        self.profiler.endStep()
         start = time.perf_counter()
-        for agent in state.agents:
-            agent.update(state, self)
-            # If user set dt via the -dt <deltatime> flag, use that. Otherwise use actual delta time as dt.                  
-        if state.useFixedTimeStep:
-            state.dt = state.fixedTimeStep
-        else:
-            state.dt = time.perf_counter() - start
+        self.engine.step(state, self)
+        self.advanceClock(state, start)
+        self.profiler.record('step', start)
+
+    # Time keeping after state has been advanced by one step which started at perf_counter() == start
+    def advanceClock(self, state, start):
+        state.lastDt = state.dt
+        state.time += state.dt
+        state.dtMin = min(state.dtMin, state.dt)
+        state.dtMax = max(state.dtMax, state.dt)
+        # If user set dt via the -dt <deltatime> flag, use that. Otherwise use actual delta time as dt.
+        # An adaptive integrator picks dt itself every step.
+        if not self.engine.integrator.adaptive:
+            if state.useFixedTimeStep:
+                state.dt = state.fixedTimeStep
+            else:
+                state.dt = time.perf_counter() - start
 
         state.runningTimePerStep = time.perf_counter() - start
         state.nTimesteps +=1
 
+    # Runs one (mean, variance, repetition) job of a sweep to completion and returns [efficiency, discomfort, termination],
+    # or None if saving is disabled. Each job gets a state with its own random number generator seeded from the
+    # job's SeedSequence, so its result does not depend on which process runs it or on which jobs ran before it.
+    # With snapshots enabled the state is saved every snapshotInterval steps and a resumed job continues from it.
+    def runJob(self, job):
+        mean, variance, seedSequence = job
+        snapshotPath = None
+        resumed = False
+        if(self.snapshotInterval > 0):
+            snapshotPath = os.path.join(self.snapshotDir, 'state_%s.pkl' % '_'.join(str(key) for key in seedSequence.spawn_key))
+        if(snapshotPath is not None and self.resume and os.path.exists(snapshotPath)):
+            state = PedsimState.loadSnapshot(snapshotPath)
+            resumed = True
+        else:
+            state = PedsimState(self.numAgents, self.dt, self.boundaryMap, mean, variance, np.random.default_rng(seedSequence), self.obstacleMap, self.compact)
+            state.attractors = self.attractors(state)
+            if(self.measureWindow > 0):
+                metrics.startWindow(state, self.measureWindow)
+            if(self.inflowRate > 0):
+                state.openBoundary = OpenBoundary(state, (self.inflowRate, self.inflowRate), self.warmupTime)
+        if(resumed and getattr(state, 'controller', None) is not None):
+            state.controller.measure = self.saveData if self.enableSaving else None
+        else:
+            state.controller = self.runController()
+        if(self.compact):
+            print('mean %.2f, variance %.2f: Memory per agent %.1f bytes' % (mean, variance, state.memoryPerAgent()))
+        recorder = None
+        if(self.recordDir is not None):
+            recordPath = os.path.join(self.recordDir, 'trajectory_%s.traj' % '_'.join(str(key) for key in seedSequence.spawn_key))
+            recorder = TrajectoryRecorder(recordPath, self.numAgents, self.recordStride, resumeAfterStep=state.nTimesteps if resumed else None)
+            if(not resumed):
+                recorder.record(state)
+        # If plotting is enabled, run simulation until user presses quit
+        if(self.enablePlotting):
+            self.visualizer.clear()
+            while not self.visualizer.terminate and state.controller.update(state) is None:
+                if(self.visualizer.running):
+                    self.advance(state, snapshotPath, recorder)
+                start = self.profiler.clock()
+                self.visualizer.visualize(state)
+                self.profiler.record('rendering', start)
+        else:
+            # If user passed --disableplotting no window will exist so no quit button
+            while state.controller.update(state) is None:
+                self.advance(state, snapshotPath, recorder)
+        if(recorder is not None):
+            recorder.close()
+        termination = state.controller.reason or QUIT
+        # A run ended by the quit button keeps its snapshot, --resume continues it from there
+        if(snapshotPath is not None and termination != QUIT and os.path.exists(snapshotPath)):
+            os.remove(snapshotPath)
+        if(state.openBoundary is not None):
+            totalFlowRate, flowRates = state.openBoundary.flowRates()
+            print('mean %.2f, variance %.2f: Flow rate %f agents/s (%s per group), Density %f agents/m^2' % (mean, variance, totalFlowRate, ', '.join('%f' % rate for rate in flowRates), state.openBoundary.density()))
+        self.reportMeasures(state)
+        if(termination != GOAL):
+            print('mean %.2f, variance %.2f: Run ended (%s) after %.1f s, %d goals' % (mean, variance, termination, state.time, state.numAgentsInGoal))
+        if(self.enableSaving):
+            return list(self.saveData(state)) + [termination]
+        return None
+
+    # Prints the per-group and windowed measures of a finished run, when enabled
+    def reportMeasures(self, state):
+        if(self.groupMeasures):
+            print('mean %.2f, variance %.2f: %s' % (state.mean, state.variance, ', '.join('group %d Efficiency %f, Discomfort %f' % ((group,) + tuple(values)) for (group, values) in sorted(metrics.groupMeasures(state).items()))))
+        if(self.measureWindow > 0):
+            print('mean %.2f, variance %.2f: Last %.1f s Efficiency %f, Discomfort %f' % ((state.mean, state.variance, self.measureWindow) + tuple(metrics.windowedMeasures(state))))
+
+    # RunController of a new run, see runcontroller.py
+    def runController(self):
+        return RunController(self.numGoalsToReach(), self.maxTime, self.stallTime, self.stallSpeed, self.steadyTolerance, self.steadyTime,
+                             self.saveData if self.enableSaving else None)
+
+    # Flow fields steering the agents of state, None without navigation. They only depend on the map,
+    # so they are computed once and shared by all states of this Pedsim (and of each worker process).
+    def attractors(self, state):
+        if not self.navigation:
+            return None
+        if self.flowFields is None:
+            self.flowFields = FlowFieldNavigation(self.boundaryMap, self.obstacleMap, state.goalLineLeft, state.goalLineRight)
+        return self.flowFields
+
+    # One step of a run: simulate, accumulate measures, record trajectories and write a snapshot when one is due
+    def advance(self, state, snapshotPath, recorder):
+        self.simulate(state)
+        profiler = self.profiler
+        if(self.enableSaving):
+            start = profiler.clock()
+            self.saveRunData(state)
+            profiler.record('metrics', start)
+        if(state.openBoundary is not None):
+            start = profiler.clock()
+            state.openBoundary.step(state)
+            profiler.record('boundary', start)
+        if(recorder is not None):
+            start = profiler.clock()
+            recorder.record(state)
+            profiler.record('recording', start)
+        if(snapshotPath is not None and state.nTimesteps % self.snapshotInterval == 0):
+            start = profiler.clock()
+            # Frames recorded so far must be on disk before a snapshot a resumed run continues them from
+            if(recorder is not None):
+                recorder.flush()
+            state.saveSnapshot(snapshotPath)
+            profiler.record('snapshot', start)
+
+    # Number of goal events after which a run ends (with an open boundary, the number of agents which left)
+    def numGoalsToReach(self):
+        AVG_NUM_GOALS_PER_AGENT = 2; #Each agent should on average enter goal 10 times, so 20 agents => 200 goals should be measured before terminating
+        return self.numAgents if not (self.continuous or self.inflowRate > 0) else self.numAgents*AVG_NUM_GOALS_PER_AGENT
+
+    # Runs all jobs and yields their results in the order of jobs.
+    # With more than one worker (and no plotting) the jobs are spread over a process pool.
+    # With ensembleSize > 1 jobs are run in batches of ensembleSize replicas stepped together by an Ensemble.
+    # Phase timings of jobs run by worker processes are merged into the profiler of this process.
+    def runJobs(self, jobs):
+        if(self.ensembleSize > 1):
+            batches = [jobs[i:i+self.ensembleSize] for i in range(0, len(jobs), self.ensembleSize)]
+            if(self.workers <= 1):
+                for batch in batches:
+                    for result in self.runEnsembleJobs(batch):
+                        yield result
+            else:
+                with concurrent.futures.ProcessPoolExecutor(max_workers=self.workers, initializer=_initWorker, initargs=(self,)) as executor:
+                    for (results, histograms) in executor.map(_runWorkerEnsembleJobs, batches):
+                        self.profiler.merge(histograms)
+                        for result in results:
+                            yield result
+        elif(self.enablePlotting or self.workers <= 1):
+            for job in jobs:
+                if(self.quit()):
+                    return
+                yield self.runJob(job)
+        else:
+            with concurrent.futures.ProcessPoolExecutor(max_workers=self.workers, initializer=_initWorker, initargs=(self,)) as executor:
+                for (result, histograms) in executor.map(_runWorkerJob, jobs):
+                    self.profiler.merge(histograms)
+                    yield result
+
+    # Runs jobs as the replicas of one Ensemble and returns their results in order, each the same as runJob would give.
+    # Replicas which have reached their goal count are masked out while the others continue.
+    def runEnsembleJobs(self, jobs):
+        states = [PedsimState(self.numAgents, self.dt, self.boundaryMap, mean, variance, np.random.default_rng(seedSequence), self.obstacleMap) for (mean, variance, seedSequence) in jobs]
+        for state in states:
+            state.attractors = self.attractors(state)
+            state.controller = self.runController()
+        ensemble = Ensemble(states, self.engine.neighborSearch, self.engine.useNumba)
+        active = np.array([state.controller.update(state) is None for state in states])
+        while active.any():
+            self.profiler.endStep()
+            start = time.perf_counter()
+            ensemble.step(active, self.continuous)
+            for r in np.flatnonzero(active):
+                self.advanceClock(states[r], start)
+            self.profiler.record('step', start)
+            if(self.enableSaving):
+                start = self.profiler.clock()
+                ensemble.accumulate(active)
+                self.profiler.record('metrics', start)
+            active = np.array([state.controller.update(state) is None for state in states])
+        for state in states:
+            self.reportMeasures(state)
+        if(self.enableSaving):
+            return [list(self.saveData(state)) + [state.controller.reason] for state in states]
+        return [None for state in states]
+
+    # (mean, variance, seedSequence) jobs of a sweep over means x variances with numAverages repetitions each, in the order run reports them.
+    # Every (mean, variance, repetition) gets an independent random stream spawned from one master seed
+    def makeJobs(self, means, variances, masterSeed):
+        jobs = []
+        for i in range(len(means)):
+            for j in range(len(variances)):
+                for k in range(self.numAverages):
+                    jobs.append((means[i], variances[j], np.random.SeedSequence(masterSeed.entropy, spawn_key=(i, j, k))))
+        return jobs
+
     def run(self):
 
         #Generate data for use in each instance of pedsimstate
 
-        NUM_MEANS = self.mus
-        NUM_VARIANCES = self.sigmas
-        AVG_NUM_GOALS_PER_AGENT = 2; #Each agent should on average enter goal 10 times, so 20 agents => 200 goals should be measured before terminating
+        NUM_MEANS = int(self.mus)
+        NUM_VARIANCES = int(self.sigmas)
         NUMBER_OF_AVERAGES = self.numAverages
         
         means = np.linspace(0.2, 4.0, NUM_MEANS)
@@ -70,71 +354,125 @@ class Pedsim:
 
         allMeans = []
         allVariances = []
-        lastTime = 0        
-        counter = 0
-        
-        pedsimStates = []
-        for i in range(len(means)):
-            for j in range(len(variances)):
-                pedsimStates.append(PedsimState(self.numAgents, self.dt, self.boundaryMap, means[i], variances[j]))
-                                
-        numRuns = 0;          
-        for state in pedsimStates:          
-            # If plotting is enabled, run simulation until user presses quit
-            # TODO MASSIVE BUG MAY HAPPEN HERE
-            tmpEfficiencies = []
-            tmpDiscomforts = []
-            for i in range(NUMBER_OF_AVERAGES):
-                state.__init__(self.numAgents, self.dt, self.boundaryMap, state.mean, state.variance)
-                if(self.enablePlotting):
-                    self.visualizer.clear()
-                    start = time.perf_counter()
-                    while not self.visualizer.terminate and state.numAgentsInGoal < (self.numAgents if not self.continuous else self.numAgents* AVG_NUM_GOALS_PER_AGENT):
-                        if(self.visualizer.running):
-                            self.simulate(state)
-                            if(self.enableSaving):
-                                self.saveRunData(state)
-                        self.visualizer.visualize(state)            
-                else:
-                    # If user passed --disableplotting no window will exist so no quit button
-                    start = time.perf_counter()
-                    while state.numAgentsInGoal < (self.numAgents if not self.continuous else self.numAgents*AVG_NUM_GOALS_PER_AGENT):
-                        self.simulate(state)
-                        if(self.enableSaving):
-                            self.saveRunData(state)
-                if(self.enableSaving):
-                    [efficiency, discomfort] = self.saveData(state)
-                    print('%.2f percentage, Efficiency: %f, Discomfort: %f' % (100.0*numRuns / (len(pedsimStates)*NUMBER_OF_AVERAGES), efficiency,discomfort))
-                numRuns += 1
-                if(self.enableSaving):
-                    tmpDiscomforts.append(discomfort)
-                    tmpEfficiencies.append(efficiency)
-            print('Total time spent: %.2f' % (time.perf_counter() - start),'  Approx time left: %.1f' %((lastTime + (time.perf_counter() - start)*(len(pedsimStates)-counter))/2.0))
+
+        # Finished jobs are appended to the result store right away. When resuming, jobs found in the
+        # store are not run again and the master seed of the stored results is reused.
+        store = None
+        if(self.enableSaving):
+            store = ResultStore(self.resultPath, self.resume)
+        seed = self.seed
+        if(store is not None and seed is None):
+            seed = store.seed()
+        if(self.snapshotInterval > 0):
+            os.makedirs(self.snapshotDir, exist_ok=True)
+        if(self.recordDir is not None):
+            os.makedirs(self.recordDir, exist_ok=True)
+
+        masterSeed = np.random.SeedSequence(seed)
+        if(self.adaptive):
+            jobs = []
+            allMeans, allVariances, efficiencies, discomforts = self.runAdaptive(means, variances, masterSeed, store)
+        else:
+            jobs = self.makeJobs(means, variances, masterSeed)
+        storedResults = [store.get(mean, variance, seedSequence.spawn_key[2], masterSeed.entropy) if store is not None else None for (mean, variance, seedSequence) in jobs]
+        pendingResults = self.runJobs([job for (job, stored) in zip(jobs, storedResults) if stored is None])
+
+        start = time.perf_counter()
+        tmpEfficiencies = []
+        tmpDiscomforts = []
+        tmpTerminations = []
+        for numRuns in range(len(jobs)):
+            mean, variance, seedSequence = jobs[numRuns]
+            result = storedResults[numRuns]
+            if(result is None):
+                result = next(pendingResults, None)
+                # Runs cut short by the quit button (and the jobs after them) are not stored, so --resume runs them
+                if(self.quit()):
+                    break
+                if(store is not None):
+                    store.append(mean, variance, seedSequence.spawn_key[2], masterSeed.entropy, result)
             if(self.enableSaving):
-                lastTime = (time.perf_counter() - start)*len(pedsimStates)
-                discomforts.append(np.mean(tmpDiscomforts))
-                efficiencies.append(np.mean(tmpEfficiencies))
-                allMeans.append(state.mean)
-                allVariances.append(state.variance)
-                counter += 1
+                [efficiency, discomfort, termination] = result
+                print('%.2f percentage, Efficiency: %f, Discomfort: %f, Ended: %s' % (100.0*numRuns / len(jobs), efficiency,discomfort,termination))
+                tmpDiscomforts.append(discomfort)
+                tmpEfficiencies.append(efficiency)
+                tmpTerminations.append(termination)
+            if((numRuns+1) % NUMBER_OF_AVERAGES == 0):
+                timeSpent = time.perf_counter() - start
+                print('Total time spent: %.2f' % timeSpent,'  Approx time left: %.1f' % (timeSpent/(numRuns+1)*(len(jobs)-numRuns-1)))
+                if(self.enableSaving):
+                    # A confidence interval needs at least two repetitions of the point
+                    if(len(tmpEfficiencies) > 1):
+                        print('mean %.2f, variance %.2f: Efficiency %f +- %f, Discomfort %f +- %f (95%%), Ended: %s' % ((mean, variance) + metrics.confidenceInterval(tmpEfficiencies) + metrics.confidenceInterval(tmpDiscomforts) + (terminationCounts(tmpTerminations),)))
+                    else:
+                        print('mean %.2f, variance %.2f: Efficiency %f, Discomfort %f, Ended: %s' % (mean, variance, np.mean(tmpEfficiencies), np.mean(tmpDiscomforts), terminationCounts(tmpTerminations)))
+                    discomforts.append(np.mean(tmpDiscomforts))
+                    efficiencies.append(np.mean(tmpEfficiencies))
+                    allMeans.append(mean)
+                    allVariances.append(variance)
+                tmpEfficiencies = []
+                tmpDiscomforts = []
+                tmpTerminations = []
             
+        self.engine.close()
+        if(self.enablePlotting):
+            self.visualizer.close()
+        if(self.profiler.enabled):
+            self.profiler.printReport()
+            if(self.profileOutput is not None):
+                self.profiler.dump(self.profileOutput)
         if(self.enableSaving):
+            store.close()
             self.saveDataToFile(allMeans,allVariances,efficiencies,discomforts)
         
+    # Runs an AdaptiveSweep over means x variances round by round, each round's jobs spread over the workers like a uniform
+    # sweep, and returns the mean, variance, efficiency and discomfort of every point it ran, ordered by mean and variance
+    def runAdaptive(self, means, variances, masterSeed, store):
+        sweep = AdaptiveSweep(means, variances, 2, self.numAverages, self.ciTolerance, self.refineThreshold, self.refinements)
+        start = time.perf_counter()
+        while True:
+            pending = sweep.pending()
+            while pending:
+                jobs = []
+                for (point, repetition) in pending:
+                    mean, variance = sweep.parameters(point)
+                    jobs.append((mean, variance, np.random.SeedSequence(masterSeed.entropy, spawn_key=sweep.spawnKey(point, repetition))))
+                storedResults = [store.get(mean, variance, seedSequence.spawn_key[2], masterSeed.entropy) for (mean, variance, seedSequence) in jobs]
+                pendingResults = self.runJobs([job for (job, stored) in zip(jobs, storedResults) if stored is None])
+                for ((point, repetition), (mean, variance, seedSequence), result) in zip(pending, jobs, storedResults):
+                    if(result is None):
+                        result = next(pendingResults, None)
+                        if(self.quit()):
+                            return self.adaptiveTable(sweep)
+                        store.append(mean, variance, repetition, masterSeed.entropy, result)
+                    if(sweep.add(point, result[:2])):
+                        values = np.array(sweep.results[point], dtype=float).reshape(-1, 2)
+                        print('mean %.3f, variance %.3f: Efficiency %f +- %f, Discomfort %f +- %f (95%%), %d runs' % ((mean, variance) + metrics.confidenceInterval(values[:, 0]) + metrics.confidenceInterval(values[:, 1]) + (len(values),)))
+                pending = sweep.pending()
+            print('Level %d done: %d points, %d runs, total time spent: %.2f' % (sweep.level, len(sweep.results), sweep.numRuns(), time.perf_counter() - start))
+            if(sweep.refine() == 0):
+                break
+        uniformPoints = ((len(means)-1)*2**sweep.level + 1)*((len(variances)-1)*2**sweep.level + 1)
+        print('Adaptive sweep: %d runs, a uniform sweep at the same resolution takes %d' % (sweep.numRuns(), uniformPoints*self.numAverages))
+        return self.adaptiveTable(sweep)
+
+    # Mean, variance, efficiency and discomfort of every point sweep has run, ordered by mean and variance
+    def adaptiveTable(self, sweep):
+        table = sweep.table()
+        return [row[0] for row in table], [row[1] for row in table], [row[2] for row in table], [row[3] for row in table]
+
+    # Whether the quit button of the window has been pressed, no further jobs are run then
+    def quit(self):
+        return self.enablePlotting and self.visualizer.terminate
+
+    # Adds this step to the running sums of the efficiency and discomfort measures, see metrics.py
     def saveRunData(self, state):
-        for agent in state.agents:
-            agent.cumSpeed += np.linalg.norm(agent.velocity)
-            agent.cumVelocity += agent.velocity
-            agent.cumSpeedPreferred += np.dot(agent.velocity,agent.preferredVelocity)/agent.preferredSpeed
-            agent.cumSpeedSquared += np.dot(agent.velocity,agent.velocity)
+        metrics.accumulate(state)
             
     def saveData(self, state):
-        efficiency = 0.0
-        discomfort = 0.0
-        for agent in state.agents:
-            efficiency += (agent.cumSpeedPreferred/state.nTimesteps) *(1.0/agent.preferredSpeed)
-            discomfort += 1 - np.dot(agent.cumVelocity/state.nTimesteps, agent.cumVelocity/state.nTimesteps)/(agent.cumSpeedSquared/state.nTimesteps)
-        return efficiency/self.numAgents, discomfort/self.numAgents
+        if(state.openBoundary is not None):
+            return state.openBoundary.measures()
+        return metrics.measures(state)
         
     def saveDataToFile(self,means, variances, efficiencies,discomforts):
         np.savetxt('text.txt',np.c_[means,variances,efficiencies,discomforts])
@@ -186,8 +524,29 @@ class Pedsim:
         
         
 
-        
+# Termination reasons of the repetitions of a point as e.g. '4 goal, 2 stalled'
+def terminationCounts(terminations):
+    counts = collections.Counter(terminations)
+    return ', '.join('%d %s' % (counts[reason], reason) for reason in sorted(counts))
+
+# Pedsim instance of a sweep worker process, set once per process by _initWorker
+_workerPedsim = None
+
+def _initWorker(pedsim):
+    global _workerPedsim
+    _workerPedsim = pedsim
+
+# Results of the job(s) and the phase timings they took, which are moved to the parent process
+def _runWorkerJob(job):
+    result = _workerPedsim.runJob(job)
+    return result, _workerPedsim.profiler.drain()
+
+def _runWorkerEnsembleJobs(jobs):
+    results = _workerPedsim.runEnsembleJobs(jobs)
+    return results, _workerPedsim.profiler.drain()
+
 def main():   
+    warnings.filterwarnings("ignore", category=np.VisibleDeprecationWarning)
     parser = argparse.ArgumentParser()
     parser.add_argument("-n", help="Sets the number of agents", type=int, default=60)
     parser.add_argument("-r", help="Sets the plot refresh rate", type=int, default=16)
@@ -201,16 +560,63 @@ def main():
     parser.add_argument("--continuous", help="Resets x-coordinate after goal", action='store_true')
     parser.add_argument("--scientificplot", help="True if plot should have grid lines and axes", action='store_true')
     parser.add_argument("--save", help="Enable saving measures to file", action='store_true');
-    parser.add_argument("-map", help="Sets map", type = int, default = 1 )
+    parser.add_argument("-map", help="Sets map, 1 for the straight corridor or a JSON obstacle map file (see obstaclemap.py and maps/)", type = str, default = '1' )
+    parser.add_argument("--engine", help="Sets engine which steps the simulation", choices=sorted(ENGINES), default='vectorized')
+    parser.add_argument("--synchronous", help="Agent engine: compute all forces from the state at the start of the step before moving any agent", action='store_true')
+    parser.add_argument("-threads", help="Sets number of threads the force phase is split over (synchronous agent engine, brute force neighbor search)", type=int, default=1)
+    parser.add_argument("-slabs", help="Splits the corridor into this many slabs whose forces are computed by one process each (vectorized engine, grid neighbor search)", type=int, default=1)
+    parser.add_argument("--neighborsearch", help="Sets how the vectorized engine finds interacting agents", choices=NEIGHBOR_SEARCHES, default='grid')
+    parser.add_argument("--kernel", help="Sets force kernel of the vectorized engine, auto uses numba when installed and the neighbor search is grid", choices=KERNELS, default='auto')
+    parser.add_argument("-j", "--workers", help="Sets number of processes to run a sweep on", type=int, default=1)
+    parser.add_argument("-results", help="Sets file finished jobs are appended to (with --save)", type=str, default='results.csv')
+    parser.add_argument("--resume", help="Skip jobs already in the results file and continue from snapshots", action='store_true')
+    parser.add_argument("-snapshotinterval", help="Save a snapshot of each run every this many steps, 0 disables", type=int, default=0)
+    parser.add_argument("-snapshotdir", help="Sets directory snapshots are saved to", type=str, default='snapshots')
+    parser.add_argument("-recorddir", help="Stream trajectories of each run to a file in this directory", type=str, default=None)
+    parser.add_argument("-recordstride", help="Record every this many steps", type=int, default=1)
+    parser.add_argument("--integrator", help="Sets integrator of the vectorized engine", choices=sorted(INTEGRATORS), default='euler')
+    parser.add_argument("-tolerance", help="Sets position error per step of the adaptive integrator", type=float, default=1e-3)
+    parser.add_argument("-dtmax", help="Sets largest time step of the adaptive integrator", type=float, default=0.1)
+    parser.add_argument("--seed", help="Sets master seed, makes every run of a sweep replayable", type=int, default=None)
+    parser.add_argument("-ensemble", help="Sets number of sweep jobs stepped together in one batch", type=int, default=1)
+    parser.add_argument("--navigation", help="Steer agents around obstacles along precomputed flow fields to their goal", action='store_true')
+    parser.add_argument("-inflow", help="Open boundary: agents arriving per second at each entrance, -n is then the most agents present at once", type=float, default=0.0)
+    parser.add_argument("-warmup", help="Sets simulated seconds before flow rate and density of an open boundary are measured", type=float, default=0.0)
+    parser.add_argument("--adaptive", help="Refine the mean/variance grid where the measures change fastest and stop repeating a point once its confidence interval is tight (with --save, -averages is then the most repetitions)", action='store_true')
+    parser.add_argument("-citolerance", help="Sets half width of the 95%% confidence interval at which --adaptive stops repeating a point", type=float, default=0.02)
+    parser.add_argument("-refinethreshold", help="Sets change of efficiency or discomfort across a grid cell above which --adaptive splits it", type=float, default=0.1)
+    parser.add_argument("-refinements", help="Sets how many times --adaptive may halve the grid spacing", type=int, default=2)
+    parser.add_argument("-maxtime", help="Sets the most simulated seconds of a run, 0 for no limit", type=float, default=0.0)
+    parser.add_argument("-stalltime", help="End a run as stalled when its mean speed over this many simulated seconds is below -stallspeed, 0 disables", type=float, default=0.0)
+    parser.add_argument("-stallspeed", help="Sets mean speed, as a fraction of the preferred speed, below which a run has stalled", type=float, default=0.05)
+    parser.add_argument("-steadytolerance", help="End a run (with --save) once its efficiency and discomfort stay within this for -steadytime seconds, 0 disables", type=float, default=0.0)
+    parser.add_argument("-steadytime", help="Sets simulated seconds the measures must stay within -steadytolerance", type=float, default=10.0)
+    parser.add_argument("--groupmeasures", help="Report the measures of every run per group (with --save)", action='store_true')
+    parser.add_argument("-window", help="Report the measures of every run over its last this many simulated seconds (with --save), 0 disables", type=float, default=0.0)
+    parser.add_argument("--compact", help="Store agents in float32 structured arrays, for very large crowds", action='store_true')
+    parser.add_argument("--profile", help="Time every phase of each step and print p50/p95/p99 at the end", action='store_true')
+    parser.add_argument("-profileoutput", help="Write the phase timings of --profile to this JSON file", type=str, default=None)
     #paser.add_argument("--savedata", help="Save data from simulation", type=bool, default = false)
     args = parser.parse_args()
 
     # Instansiate and run model
-    bMap = Boundarymap()
-    boundaryMap = bMap.boundaryMap1()
+    obstacleMap = None
+    if(args.map == '1'):
+        bMap = Boundarymap()
+        boundaryMap = bMap.boundaryMap1()
+    else:
+        obstacleMap = ObstacleMap.load(args.map)
+        boundaryMap = obstacleMap.boundaryMap()
     
     # Instansiate and run model
-    pedsim = Pedsim(args.n, args.direction, args.acceleration, args.r, args.dt, args.mu, args.sigma, not args.disableplotting, args.continuous, args.scientificplot, args.save, args.averages, boundaryMap)
+    pedsim = Pedsim(args.n, args.direction, args.acceleration, args.r, args.dt, args.mu, args.sigma, not args.disableplotting, args.continuous, args.scientificplot, args.save, args.averages, boundaryMap,
+                    engine=args.engine, neighborSearch=args.neighborsearch, workers=args.workers, seed=args.seed, resultPath=args.results, resume=args.resume,
+                    snapshotInterval=args.snapshotinterval, snapshotDir=args.snapshotdir, kernel=args.kernel, recordDir=args.recorddir, recordStride=args.recordstride,
+                    integrator=args.integrator, tolerance=args.tolerance, dtMax=args.dtmax, ensembleSize=args.ensemble, profile=args.profile, profileOutput=args.profileoutput,
+                    obstacleMap=obstacleMap, navigation=args.navigation, inflowRate=args.inflow, warmupTime=args.warmup, compact=args.compact,
+                    adaptive=args.adaptive, ciTolerance=args.citolerance, refineThreshold=args.refinethreshold, refinements=args.refinements,
+                    maxTime=args.maxtime, stallTime=args.stalltime, stallSpeed=args.stallspeed, steadyTolerance=args.steadytolerance, steadyTime=args.steadytime,
+                    synchronous=args.synchronous, threads=args.threads, slabs=args.slabs, groupMeasures=args.groupmeasures, measureWindow=args.window)
     pedsim.run()
 
 if __name__ == "__main__":
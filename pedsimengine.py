@@ -0,0 +1,296 @@
+import numpy as np
+import warnings
+import concurrent.futures
+from agent import *
+from neighborgrid import NeighborGrid
+import forcekernel
+import integrators
+from phaseprofiler import NULL_PROFILER
+
+# Forces of the social force model computed for all agents of a PedsimState at once.
+# Each function takes the agent arrays of a PedsimState and returns a (numAgents, 2) array,
+# agent i gets exactly the same force as Agent.behavioral would give it.
+
+# Relaxation towards the preferred velocity
+def drivingForces(preferredVelocities, velocities):
+    return (preferredVelocities - velocities)/RELAXATION
+
+# Exponential repulsion from the closest of the top and bottom wall of the corridor
+def wallForces(positions, boundaryMap):
+    upperBound = np.size(boundaryMap, 0)-1
+    lowerBound = 0
+    distanceToLower = np.abs(positions[:, 1] - lowerBound)
+    distanceToHigher = np.abs(positions[:, 1] - upperBound)
+    forces = np.zeros(np.shape(positions))
+    closerToLower = distanceToLower < distanceToHigher
+    forces[:, 1] = np.where(closerToLower,
+                            np.exp(WALL_SCALAR/np.where(closerToLower, distanceToLower, 1.0)) - 1.0,
+                            -(np.exp(WALL_SCALAR/np.where(closerToLower, 1.0, distanceToHigher)) - 1.0))
+    return forces
+
+# Almost Coulomb repulsion between every pair of agents closer than RMIN1 (same group) or RMIN2 (other group).
+# Uses sum_j w_ij*(r_i - r_j) = r_i*sum_j w_ij - (w @ r)_i so only (numAgents, numAgents) scalars are built.
+# first and last restrict it to the forces on agents first..last-1, a (last-first, 2) array. Row sums are taken with
+# einsum rather than BLAS, whose summation order depends on the shape, so any split into blocks gives the same bits.
+def pairForces(positions, groups, first=0, last=None):
+    if last is None:
+        last = len(positions)
+    rows = positions[first:last]
+    dx = rows[:, 0, np.newaxis] - positions[np.newaxis, :, 0]
+    dy = rows[:, 1, np.newaxis] - positions[np.newaxis, :, 1]
+    rabdot = dx*dx + dy*dy
+    rabdot[np.arange(last-first), np.arange(first, last)] = np.inf
+    sameGroup = groups[first:last, np.newaxis] == groups[np.newaxis, :]
+    w1 = np.where(sameGroup & (rabdot < RMIN1), COULUMB_SCALAR1, 0.0)/rabdot
+    w2 = np.where(~sameGroup & (rabdot < RMIN2), COULUMB_SCALAR2, 0.0)/rabdot
+    wx = w1 + w2
+    wy = Y_MAGNIFICATION1*w1 + Y_MAGNIFICATION2*w2
+    forces = np.empty(np.shape(rows))
+    forces[:, 0] = rows[:, 0]*wx.sum(1) - np.einsum('ij,j->i', wx, positions[:, 0])
+    forces[:, 1] = rows[:, 1]*wy.sum(1) - np.einsum('ij,j->i', wy, positions[:, 1])
+    return forces
+
+# Same as pairForces but only over the candidate pairs (i, j) given by a neighbor search,
+# each unordered pair must be given in both orders
+def pairForcesFromPairs(positions, groups, i, j):
+    rab = positions[i] - positions[j]
+    rabdot = np.einsum('ij,ij->i', rab, rab)
+    sameGroup = groups[i] == groups[j]
+    w1 = np.where(sameGroup & (rabdot < RMIN1), COULUMB_SCALAR1, 0.0)/rabdot
+    w2 = np.where(~sameGroup & (rabdot < RMIN2), COULUMB_SCALAR2, 0.0)/rabdot
+    forces = np.empty(np.shape(positions))
+    forces[:, 0] = np.bincount(i, weights=(w1 + w2)*rab[:, 0], minlength=len(positions))
+    forces[:, 1] = np.bincount(i, weights=(Y_MAGNIFICATION1*w1 + Y_MAGNIFICATION2*w2)*rab[:, 1], minlength=len(positions))
+    return forces
+
+# Uniform noise in [-1, 1) for every component, drawn as one block from the random number generator rng
+def fluctuations(rng, numAgents):
+    MAX = 1; MIN = -1
+    return rng.random((numAgents, 2)) * (MAX-MIN) + MIN
+
+# Calls function(first, last) for numThreads contiguous blocks of the agents 0..numAgents-1, in the threads of
+# executor (or in this thread if it is None) and returns when all are done. Each call must only write the rows
+# of its own agents, then the result is the same for any number of threads.
+def forEachBlock(executor, numThreads, numAgents, function):
+    bounds = np.linspace(0, numAgents, numThreads + 1).astype(int)
+    if executor is None or numThreads == 1:
+        function(0, numAgents)
+        return
+    for future in [executor.submit(function, first, last) for (first, last) in zip(bounds[:-1], bounds[1:]) if last > first]:
+        future.result()
+
+# Velocity constraints and boundary and goal handling of engines which update all agents at once from the agent
+# arrays, and the thread pool their force phase is split over (numThreads > 1, see forEachBlock)
+class ArrayEngine:
+    numThreads = 1
+    executor = None
+
+    def threadPool(self):
+        if self.numThreads > 1 and self.executor is None:
+            self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.numThreads)
+        return self.executor
+
+    # Threads are not copied into sweep worker processes, each process starts its own pool
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop('executor', None)
+        return state
+
+    # Stops the thread pool, called by Pedsim when a run is over
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+
+    def fluctuations(self, state):
+        start = self.profiler.clock()
+        noise = fluctuations(state.rng, state.numAgents)
+        self.profiler.record('fluctuations', start)
+        return noise
+
+    # Agents may not walk backwards and not faster than MAX_SPEED
+    def constrainVelocities(self, state):
+        velocities = state.velocities
+        group0 = state.groups == 0
+        velocities[group0 & (velocities[:, 0] < 0), 0] = 0.01
+        velocities[~group0 & (velocities[:, 0] > 0), 0] = -0.01
+
+        # Cap magnitude of vector to 12.4m/s (Usain Bolt 2009 Berlin)
+        speeds = np.sqrt(np.einsum('ij,ij->i', velocities, velocities))
+        tooFast = speeds > MAX_SPEED
+        velocities[tooFast] *= (MAX_SPEED/speeds[tooFast])[:, np.newaxis]
+
+    # Confines agents to the corridor and counts agents which reached their goal, after positions have been advanced
+    def finishStep(self, state, pedsim):
+        start = self.profiler.clock()
+        positions = state.positions
+
+        # Confine agents within boundary
+        np.clip(positions[:, 1], 0+WALL_WIDTH, np.size(state.boundaryMap, 0)-1-WALL_WIDTH, out=positions[:, 1])
+        if(state.obstacleMap is not None):
+            state.obstacleMap.confine(positions)
+
+        # Check if agents reached goal
+        reachedGoal = ~state.inGoal & np.where(state.groups == 0, positions[:, 0] > state.goalLineRight, positions[:, 0] < state.goalLineLeft)
+        state.inGoal |= reachedGoal
+        state.goalCounts += reachedGoal
+        state.numAgentsInGoal += int(np.count_nonzero(reachedGoal))
+        if(pedsim.continuous):
+            positions[state.inGoal, 0] = state.positions0[state.inGoal, 0]
+            state.inGoal[:] = False
+        self.profiler.record('goals', start)
+
+# Engine which steps a PedsimState by calling Agent methods once per agent. It always uses brute force neighbor search.
+# By default (synchronous=False) Agent.update moves the agents in place one after the other, this is the original model
+# and is kept as a reference for the vectorized engine: agent k already sees agents 0..k-1 moved, so results depend on
+# the order of the agents. With synchronous=True all agents evaluate Agent.socialForce against the positions and velocities
+# at the start of the step, which stay untouched until every force has been written into a second buffer, and are then
+# advanced together by integrator (any of integrators.py, 'euler' by default). The force phase can then be split over
+# numThreads threads without changing results. The sequential update only implements the 'euler' scheme.
+class AgentEngine(ArrayEngine):
+    def __init__(self, neighborSearch='bruteforce', kernel='numpy', integrator=None, synchronous=False, numThreads=1):
+        self.neighborSearch = neighborSearch
+        self.kernel = kernel
+        if integrator is not None and not synchronous and not isinstance(integrator, integrators.EulerIntegrator):
+            warnings.warn("the sequential agent engine only implements the euler integrator, use synchronous for other integrators")
+            integrator = None
+        self.integrator = integrator if integrator is not None else integrators.EulerIntegrator()
+        self.profiler = NULL_PROFILER
+        self.synchronous = synchronous
+        self.numThreads = numThreads
+        self.buffer = np.zeros((0, 2)) #Forces of the step being computed, reused while the number of agents stays the same
+
+    def step(self, state, pedsim):
+        if self.synchronous:
+            self.integrator.step(self, state, pedsim)
+            return
+        for agent in state.agents:
+            agent.update(state, pedsim)
+
+    # Total force on every agent, all evaluated against the state as it was at the start of the step
+    def forces(self, state):
+        # Drawn as one block in agent order, the same random numbers the agents draw one by one in Agent.update
+        return self.agentForces(state, Agent.socialForce) + self.fluctuations(state)
+
+    # Wall and interaction forces, i.e. the total force without relaxation and fluctuation
+    def externalForces(self, state):
+        return np.copy(self.agentForces(state, Agent.externalForce))
+
+    # force(agent, agents, boundaryMap, attractors) of every agent, written into the force buffer
+    def agentForces(self, state, force):
+        start = self.profiler.clock()
+        if len(self.buffer) != state.numAgents:
+            self.buffer = np.zeros((state.numAgents, 2))
+        buffer = self.buffer
+        agents = state.agents
+        def evaluate(first, last):
+            for k in range(first, last):
+                buffer[k] = force(agents[k], agents, state.boundaryMap, state.attractors)
+        forEachBlock(self.threadPool(), self.numThreads, state.numAgents, evaluate)
+        self.profiler.record('agentForces', start)
+        return buffer
+
+# Engine which steps a PedsimState with a handful of batched operations over the agent arrays.
+# All agents see the positions and velocities of the previous step (synchronous update),
+# with the default 'euler' integrator it otherwise does exactly what Agent.update does.
+# neighborSearch='bruteforce' evaluates all numAgents^2 pairs, neighborSearch='grid' only visits
+# agents in adjacent cells of a NeighborGrid, which gives the same forces in O(numAgents) per step.
+# kernel='numba' computes the total force of all agents in one call to the compiled kernel in forcekernel.py
+# (always with grid neighbor search), kernel='auto' does so when numba is installed and neighborSearch is 'grid'
+# and uses NumPy otherwise.
+# integrator is one of the integrators in integrators.py which advances positions and velocities from the forces.
+# The time of every phase of a step goes to profiler (see phaseprofiler.py), which Pedsim sets when profiling.
+# numThreads > 1 splits the brute force pair forces over threads by blocks of agents. synchronous is accepted
+# for the same constructor as AgentEngine, this engine always updates synchronously.
+class VectorizedEngine(ArrayEngine):
+    def __init__(self, neighborSearch='grid', kernel='auto', integrator=None, synchronous=True, numThreads=1):
+        self.neighborSearch = neighborSearch
+        self.numThreads = numThreads
+        self.grid = NeighborGrid(np.sqrt(max(RMIN1, RMIN2)))
+        if kernel == 'numba' and not forcekernel.numbaAvailable:
+            warnings.warn("numba is not installed, falling back to the NumPy force kernel")
+        self.useNumba = forcekernel.numbaAvailable and (kernel == 'numba' or (kernel == 'auto' and neighborSearch == 'grid'))
+        if self.useNumba and neighborSearch != 'grid':
+            warnings.warn("the numba force kernel always uses grid neighbor search, ignoring neighborSearch")
+            self.neighborSearch = 'grid'
+        self.integrator = integrator if integrator is not None else integrators.EulerIntegrator()
+        self.profiler = NULL_PROFILER
+
+    def step(self, state, pedsim):
+        if state.attractors is not None:
+            self.steer(state)
+        self.integrator.step(self, state, pedsim)
+
+    # Points the preferred velocity of every agent along the flow field of its goal (state.attractors, see navigation.py)
+    def steer(self, state):
+        start = self.profiler.clock()
+        state.preferredVelocities[:] = state.preferredSpeeds[:, np.newaxis]*state.attractors.preferredDirections(state.positions, state.groups)
+        self.profiler.record('navigation', start)
+
+    # Total force on every agent at the current positions and velocities, fluctuation included
+    def forces(self, state):
+        profiler = self.profiler
+        if self.useNumba:
+            return self.kernelForces(state, self.fluctuations(state))
+        start = profiler.clock()
+        forces = drivingForces(state.preferredVelocities, state.velocities)
+        profiler.record('drivingForces', start)
+        start = profiler.clock()
+        forces += self.wallForces(state)
+        profiler.record('wallForces', start)
+        forces += self.interactionForces(state)
+        return forces + self.fluctuations(state)
+
+    # Wall and interaction forces, i.e. the total force without relaxation and fluctuation
+    def externalForces(self, state):
+        profiler = self.profiler
+        if self.useNumba:
+            return self.kernelForces(state, np.zeros((state.numAgents, 2)), state.velocities)
+        start = profiler.clock()
+        forces = self.wallForces(state)
+        profiler.record('wallForces', start)
+        return forces + self.interactionForces(state)
+
+    # Total force of the compiled kernel with the given fluctuations, preferredVelocities overrides those of state
+    def kernelForces(self, state, noise, preferredVelocities=None):
+        profiler = self.profiler
+        start = profiler.clock()
+        self.grid.rebuild(state.positions, state.boundaryMap)
+        profiler.record('neighborSearch', start)
+        start = profiler.clock()
+        forces = forcekernel.totalForces(state, self.grid, noise, preferredVelocities)
+        profiler.record('forceKernel', start)
+        return forces
+
+    # Corridor walls, or the walls and obstacles of the obstacle map of state
+    def wallForces(self, state):
+        if state.obstacleMap is not None:
+            return state.obstacleMap.wallForces(state.positions)
+        return wallForces(state.positions, state.boundaryMap)
+
+    def interactionForces(self, state):
+        profiler = self.profiler
+        if self.neighborSearch == 'bruteforce':
+            start = profiler.clock()
+            if self.numThreads > 1:
+                forces = np.empty((state.numAgents, 2))
+                def evaluate(first, last):
+                    forces[first:last] = pairForces(state.positions, state.groups, first, last)
+                forEachBlock(self.threadPool(), self.numThreads, state.numAgents, evaluate)
+            else:
+                forces = pairForces(state.positions, state.groups)
+            profiler.record('pairForces', start)
+            return forces
+        start = profiler.clock()
+        self.grid.rebuild(state.positions, state.boundaryMap)
+        i, j = self.grid.pairs(state.positions)
+        profiler.record('neighborSearch', start)
+        start = profiler.clock()
+        forces = pairForcesFromPairs(state.positions, state.groups, i, j)
+        profiler.record('pairForces', start)
+        return forces
+
+ENGINES = {'vectorized': VectorizedEngine, 'agent': AgentEngine}
+NEIGHBOR_SEARCHES = ['grid', 'bruteforce']
+KERNELS = ['auto', 'numpy', 'numba']
+INTEGRATORS = integrators.INTEGRATORS
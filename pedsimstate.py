@@ -1,18 +1,31 @@
 import numpy as np
 import time
-import warnings
-warnings.filterwarnings("ignore", category=np.VisibleDeprecationWarning)
-from agent import Agent
+import os
+import pickle
+import sys
+from agent import Agent, AgentSequence
+
+# Layout of one agent in a compact PedsimState: float32 kinematics, int8 group and float64 running sums
+# (float32 sums of dt-weighted terms drift over the hundreds of thousands of steps of long runs)
+COMPACT_DTYPE = np.dtype([('positions', '<f4', (2,)), ('positions0', '<f4', (2,)), ('velocities', '<f4', (2,)),
+                          ('preferredVelocities', '<f4', (2,)), ('accelerations', '<f4', (2,)), ('preferredSpeeds', '<f4'),
+                          ('groups', 'i1'), ('inGoal', '?'), ('goalCounts', '<i4'), ('cumVelocity', '<f8', (2,)),
+                          ('cumSpeed', '<f8'), ('cumSpeedPreferred', '<f8'), ('cumSpeedSquared', '<f8')])
 
 # PedsimState holds whatever data that defines an instance of a simulation
 # So if we want to run Pedsim for different set of parameters, it boils down to
 # instanciating different PedsimStates and feeding each PedsimState to Pedsim.update(PedsimState)
 # Any PedsimState can be fed to PedsimVisualizer via PedsimVisualizer.visualize(PedsimState)
+# A compact state keeps all agent data in one structured array of COMPACT_DTYPE records (state.records),
+# the agent arrays are field views into it and agents are created on demand, see memoryPerAgent.
 class PedsimState:
-    def __init__(self, numAgents, dt, boundaryMap, mean, variance):
+    def __init__(self, numAgents, dt, boundaryMap, mean, variance, rng=None, obstacleMap=None, compact=False):
 
         self.boundaryMap = None
-        self.attractors = None
+        self.obstacleMap = None #ObstacleMap with the walls and obstacles of boundaryMap, None for the straight corridor
+        self.openBoundary = None #OpenBoundary which lets agents in and out of the corridor, None for a fixed set of agents
+        self.controller = None #RunController deciding when the run ends (runcontroller.py), set by Pedsim
+        self.attractors = None #Flow fields which steer the preferred velocities (navigation.FlowFieldNavigation), None keeps them constant
 
         self.useFixedTimeStep = False
         self.fixedTimeStep = None
@@ -34,12 +47,28 @@ class PedsimState:
 
         #Variables to save data from..
         self.nTimesteps = 0.0
+        self.time = 0.0 #Simulated time
+        self.lastDt = 0.0 #Time step of the last call to simulate, the weight of that step in the measures
+        self.dtMin = np.inf #Smallest and largest time step taken so far
+        self.dtMax = 0.0
+        self.measuredTime = 0.0 #Simulated time over which measures have been accumulated
         self.efficiencyLevels = []
         self.discomfortLevels = []
+        # Exponentially weighted window sums, allocated by metrics.startWindow
+        self.windowTime = None
+        self.windowWeight = None
+        self.windowVelocity = None
+        self.windowSpeedPreferred = None
+        self.windowSpeedSquared = None
 
         self.agents = []
+        self.records = None #Structured array of all agent data of a compact state, None otherwise
+        # Random number generator of this state, all random draws of a run (initial agents and fluctuations) come from it
+        # so a run is exactly replayable from its seed. Pedsim seeds it per (mean, variance, repetition).
+        self.rng = rng if rng is not None else np.random.default_rng()
         self.dt = dt
         self.boundaryMap = boundaryMap
+        self.obstacleMap = obstacleMap
         self.numAgents = numAgents
         self.mean = mean
         self.variance = variance
@@ -59,19 +88,102 @@ class PedsimState:
         self.goalLineLeft = wallXStart+margin+side
 
         numAgents1 = int(self.numAgents/2);
-        agentsXs = np.random.uniform(wallXStart+margin, wallXStart+margin+side, numAgents1)
-        agentsYs = np.random.uniform(wallYStart+margin, wallYEnd-margin, numAgents1)
-        preferredSpeed = np.random.normal(mean, variance, numAgents1)
-        for i in range(numAgents1):
-            self.agents.append(Agent(np.array([agentsXs[i], agentsYs[i]]), np.maximum(minimumSpeed, preferredSpeed[i])*np.array([1.0, 0.0]), 0))
-
         numAgents2 = self.numAgents-int((self.numAgents/2))
-        agentsXs = np.random.uniform(wallXEnd-margin-side, wallXEnd-margin, numAgents2)
-        agentsYs = np.random.uniform(wallYStart+margin, wallYEnd-margin, numAgents2)
-        preferredSpeed = np.random.normal(mean, variance, numAgents2)
-        for i in range(numAgents2):
-            self.agents.append(Agent(np.array([agentsXs[i], agentsYs[i]]), np.maximum(minimumSpeed, preferredSpeed[i])*np.array([-1.0, 0.0]), 1))
+        agentsXs1 = self.rng.uniform(wallXStart+margin, wallXStart+margin+side, numAgents1)
+        agentsYs1 = self.rng.uniform(wallYStart+margin, wallYEnd-margin, numAgents1)
+        preferredSpeed1 = self.rng.normal(mean, variance, numAgents1)
+        agentsXs2 = self.rng.uniform(wallXEnd-margin-side, wallXEnd-margin, numAgents2)
+        agentsYs2 = self.rng.uniform(wallYStart+margin, wallYEnd-margin, numAgents2)
+        preferredSpeed2 = self.rng.normal(mean, variance, numAgents2)
+        if(obstacleMap is not None):
+            # Draw agents which landed on or in an obstacle again
+            agentsXs1, agentsYs1 = self.spawnOutsideObstacles(agentsXs1, agentsYs1, wallXStart+margin, wallXStart+margin+side, wallYStart+margin, wallYEnd-margin)
+            agentsXs2, agentsYs2 = self.spawnOutsideObstacles(agentsXs2, agentsYs2, wallXEnd-margin-side, wallXEnd-margin, wallYStart+margin, wallYEnd-margin)
+
+        # All agent data lives in contiguous (numAgents, ...) arrays, group 0 first.
+        # self.agents holds Agent views onto these arrays for code that works per agent.
+        self.groups = np.concatenate((np.zeros(numAgents1, dtype=int), np.ones(numAgents2, dtype=int)))
+        self.positions = np.column_stack((np.concatenate((agentsXs1, agentsXs2)), np.concatenate((agentsYs1, agentsYs2))))
+        self.positions0 = np.copy(self.positions)
+        self.preferredSpeeds = np.maximum(minimumSpeed, np.concatenate((preferredSpeed1, preferredSpeed2)))
+        self.preferredVelocities = np.zeros((self.numAgents, 2))
+        self.preferredVelocities[:, 0] = np.where(self.groups == 0, 1.0, -1.0)*self.preferredSpeeds
+        self.velocities = np.copy(self.preferredVelocities)
+        self.accelerations = np.zeros((self.numAgents, 2))
+        self.inGoal = np.zeros(self.numAgents, dtype=bool)
+        self.goalCounts = np.zeros(self.numAgents, dtype=int) #Number of times each agent has reached its goal
+        self.cumVelocity = np.zeros((self.numAgents, 2))
+        self.cumSpeed = np.zeros(self.numAgents)
+        self.cumSpeedPreferred = np.zeros(self.numAgents)
+        self.cumSpeedSquared = np.zeros(self.numAgents)
+        if(compact):
+            self.records = np.zeros(self.numAgents, dtype=COMPACT_DTYPE)
+            for name in COMPACT_DTYPE.names:
+                self.records[name] = getattr(self, name)
+            self.bindRecords()
+        else:
+            self.agents = [Agent(self, i) for i in range(self.numAgents)]
 
         if(dt != 0.0):
             self.useFixedTimeStep = True
-            self.fixedTimeStep = dt
\ No newline at end of file
+            self.fixedTimeStep = dt
+
+    # Redraws positions in the rectangle [xMin, xMax] x [yMin, yMax] until no agent is within SPAWN_CLEARANCE of an obstacle
+    def spawnOutsideObstacles(self, xs, ys, xMin, xMax, yMin, yMax):
+        SPAWN_CLEARANCE = 0.3
+        MAX_TRIES = 100
+        for k in range(MAX_TRIES):
+            blocked = self.obstacleMap.distance(np.column_stack((xs, ys))) < SPAWN_CLEARANCE
+            numBlocked = np.count_nonzero(blocked)
+            if numBlocked == 0:
+                break
+            xs[blocked] = self.rng.uniform(xMin, xMax, numBlocked)
+            ys[blocked] = self.rng.uniform(yMin, yMax, numBlocked)
+        return xs, ys
+
+    # Points the agent arrays at the fields of self.records
+    def bindRecords(self):
+        for name in COMPACT_DTYPE.names:
+            setattr(self, name, self.records[name])
+        self.agents = AgentSequence(self)
+
+    # Pickled field views come back as separate arrays, point them at the records again. The pool of an open boundary
+    # is the records too, and the agent arrays only its active rows.
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self.__dict__.get('records') is not None:
+            self.bindRecords()
+            openBoundary = self.__dict__.get('openBoundary')
+            if openBoundary is not None:
+                for name in COMPACT_DTYPE.names:
+                    openBoundary.pool[name] = self.records[name]
+                openBoundary.resize(self, openBoundary.numActive)
+
+    # Bytes of agent data (arrays and Agent objects) per agent
+    def memoryPerAgent(self):
+        if self.records is not None:
+            return float(self.records.itemsize)
+        if self.numAgents == 0:
+            return 0.0
+        arrays = [self.positions, self.positions0, self.velocities, self.preferredVelocities, self.accelerations, self.groups, self.inGoal,
+                  self.goalCounts, self.preferredSpeeds, self.cumVelocity, self.cumSpeed, self.cumSpeedPreferred, self.cumSpeedSquared]
+        total = sum(array.nbytes for array in arrays)
+        if isinstance(self.agents, list):
+            total += sys.getsizeof(self.agents) + sum(sys.getsizeof(agent) + sys.getsizeof(agent.__dict__) for agent in self.agents)
+        return total/float(self.numAgents)
+
+    # Writes everything needed to continue this run exactly where it stopped (agent arrays, nTimesteps,
+    # goal counters and the random number generator) to path. The file is replaced atomically
+    # so a crash while writing leaves the previous snapshot intact.
+    def saveSnapshot(self, path):
+        tmpPath = path + '.tmp'
+        with open(tmpPath, 'wb') as f:
+            pickle.dump({'state': self}, f, pickle.HIGHEST_PROTOCOL)
+        os.replace(tmpPath, path)
+
+    # Returns the PedsimState saved to path by saveSnapshot
+    @staticmethod
+    def loadSnapshot(path):
+        with open(path, 'rb') as f:
+            snapshot = pickle.load(f)
+        return snapshot['state']
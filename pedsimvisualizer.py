@@ -1,18 +1,18 @@
 import numpy as np
 import time
 import argparse
+import multiprocessing
 import pyqtgraph as pg
 from pyqtgraph.Qt import QtGui, QtCore
-import warnings
-warnings.filterwarnings("ignore", category=np.VisibleDeprecationWarning)
 
 pg.setConfigOption('background', 'w')
 pg.setConfigOption('foreground', 'k')
 pg.setConfigOption('antialias', False)
 
 # Class which visualizes a PedsimState using the python library pyqtgraph
+# Walls are the top and bottom of the corridor, or the edges of obstacleMap if one is given
 class PedsimVisualizer:
-    def __init__(self, plotdirections, plotaccelerations, plotRefreshRate, dt, enablePlotting, scientificplot, boundaryMap):
+    def __init__(self, plotdirections, plotaccelerations, plotRefreshRate, dt, enablePlotting, scientificplot, boundaryMap, obstacleMap=None):
         self.app = None
         self.w = None
         self.runBtn = None
@@ -80,6 +80,19 @@ class PedsimVisualizer:
         #self.layout.addWidget(self.dataPlot, 0, 2, 1, 1)
 
         self.wallPen = pg.mkPen(color=(100, 100, 100), width=3)
+        self.wallLines = None
+        self.obstacleMap = obstacleMap
+
+        # Plot items which are created once and updated in place by visualize
+        self.groupBrushes = [pg.mkBrush(255, 0, 0, 255), pg.mkBrush(0, 0, 255, 255)]
+        self.agentGroups = None
+        self.agentBrushes = None
+        self.agentScatter = pg.ScatterPlotItem(pen=None, symbol='o', size=0.6, pxMode=False)
+        self.directionArrows = pg.PlotDataItem(pen={'color': (100,241,64), 'width': 0.5})
+        self.accelerationArrows = pg.PlotDataItem(pen={'color': (241, 100, 64), 'width': 0.5})
+        self.agentPlot.addItem(self.agentScatter)
+        self.agentPlot.addItem(self.directionArrows)
+        self.agentPlot.addItem(self.accelerationArrows)
 
         
         self.w.show()
@@ -100,20 +113,24 @@ class PedsimVisualizer:
         self.enablePlotting = not self.enablePlotting
         self.togglePlottingBtn.setText("Disable plotting " if self.enablePlotting else "Enable plotting")
 
+    # Draws a PedsimState, or a Frame published by a simulation running in another process.
+    # All agents are drawn by one ScatterPlotItem and all direction/acceleration arrows by one
+    # PlotDataItem with connect='pairs', these items are created once and updated in place.
     def visualize(self, state):
         self.app.processEvents() # Such as moving the window, pressing buttons etc
         # Update plot, 60fps
         if(self.running and self.enablePlotting and (time.perf_counter() - self.plotTime)*1000 > self.plotRefreshRate):
-            xs = [agent.position[0] for agent in state.agents]
-            ys = [agent.position[1] for agent in state.agents]
-
-
-            half = int(len(xs)/2)
-            
-            self.agentPlot.plot(xs[1:half], ys[1:half], pen= None,symbol='o', clear=True, symbolSize=0.6, pxMode=False, symbolBrush=(255,0,0,255))
-            self.agentPlot.plot(xs[half:-1], ys[half:-1], pen=None, symbol='o',clear=False, symbolSize=0.6, pxMode=False, symbolBrush=(0,0,255,255))
-            self.agentPlot.addLine(y=0, pen=self.wallPen)
-            self.agentPlot.addLine(y=np.size(state.boundaryMap, 0)-1, pen=self.wallPen)
+            positions = state.positions
+            if(self.agentGroups is None or not np.array_equal(self.agentGroups, state.groups)):
+                self.agentGroups = np.copy(state.groups)
+                self.agentBrushes = [self.groupBrushes[group % len(self.groupBrushes)] for group in self.agentGroups]
+            self.agentScatter.setData(x=positions[:, 0], y=positions[:, 1], brush=self.agentBrushes)
+            if(self.wallLines is None):
+                if(self.obstacleMap is not None):
+                    edges = self.obstacleMap.edges()
+                    self.wallLines = [self.agentPlot.plot(x=edges[:, :, 0].ravel(), y=edges[:, :, 1].ravel(), connect='pairs', pen=self.wallPen)]
+                else:
+                    self.wallLines = [self.agentPlot.addLine(y=0, pen=self.wallPen), self.agentPlot.addLine(y=np.size(state.boundaryMap, 0)-1, pen=self.wallPen)]
 
             #Dummyvariable could really be a tuple or anything that we want to plot
             self.data3[self.ptr3] = state.totalDistanceTravelled
@@ -127,18 +144,139 @@ class PedsimVisualizer:
                             
             self.plotTime = time.perf_counter()
 
-            # FIXME: !!!MAJOR CHOKEPOINT!!! totally worthless
             if(self.plotdirections):
-                for agent in state.agents:
-                    self.agentPlot.plot([agent.position[0], agent.position[0] + agent.velocity[0]/20], [agent.position[1], agent.position[1] + agent.velocity[1]/20], pen={'color': (100,241,64), 'width': 0.5})
+                self.setArrows(self.directionArrows, positions, state.velocities/20)
             if(self.plotaccelerations):
-                for agent in state.agents:
-                    self.agentPlot.plot([agent.position[0], agent.position[0] + agent.acceleration[0]/20], [agent.position[1], agent.position[1] + agent.acceleration[1]/20], pen={'color': (241, 100, 64), 'width': 0.5})
+                self.setArrows(self.accelerationArrows, positions, state.accelerations/20)
 
             self.agentPlot.setTitle("Rtpi: %.2fms, naig: %i" % (round(state.runningTimePerStep*1000, 2), state.numAgentsInGoal))
             self.dataPlot.setTitle("%.2fm" % state.totalDistanceTravelled)
 
+    # Draws one line segment from each position to position + offset
+    def setArrows(self, arrows, positions, offsets):
+        xs = np.empty(2*len(positions))
+        ys = np.empty(2*len(positions))
+        xs[0::2] = positions[:, 0]
+        xs[1::2] = positions[:, 0] + offsets[:, 0]
+        ys[0::2] = positions[:, 1]
+        ys[1::2] = positions[:, 1] + offsets[:, 1]
+        arrows.setData(xs, ys, connect='pairs')
+
     def clear(self):
-        self.agentPlot.clear()
+        self.agentScatter.clear()
+        self.directionArrows.clear()
+        self.accelerationArrows.clear()
         self.dataPlot.clear()
         self.dataCurve.clear()
+
+# One snapshot of the agents of a PedsimState as read from a FrameBuffer, has the attributes PedsimVisualizer.visualize draws
+class Frame:
+    def __init__(self, sequence, positions, velocities, accelerations, groups, numAgentsInGoal, runningTimePerStep, totalDistanceTravelled, boundaryMap):
+        self.sequence = sequence
+        self.positions = positions
+        self.velocities = velocities
+        self.accelerations = accelerations
+        self.groups = groups
+        self.numAgentsInGoal = numAgentsInGoal
+        self.runningTimePerStep = runningTimePerStep
+        self.totalDistanceTravelled = totalDistanceTravelled
+        self.boundaryMap = boundaryMap
+
+# Single frame buffer in shared memory where the simulation publishes agent snapshots and the renderer
+# process reads them. Publishing overwrites the previous frame (latest frame wins), so a slow renderer
+# makes the simulation skip frames instead of waiting for it. capacity is the largest number of agents.
+class FrameBuffer:
+    INFO_SIZE = 4 # numAgents, numAgentsInGoal, runningTimePerStep, totalDistanceTravelled
+
+    def __init__(self, capacity, context):
+        self.capacity = capacity
+        self.lock = context.Lock()
+        self.sequence = context.RawValue('q', 0)
+        self.info = context.RawArray('d', self.INFO_SIZE)
+        self.data = context.RawArray('d', 7*capacity) # positions, velocities, accelerations and groups
+
+    def views(self):
+        data = np.frombuffer(self.data, dtype=float)
+        c = self.capacity
+        return data[0:2*c].reshape(c, 2), data[2*c:4*c].reshape(c, 2), data[4*c:6*c].reshape(c, 2), data[6*c:7*c]
+
+    def publish(self, state):
+        positions, velocities, accelerations, groups = self.views()
+        n = min(len(state.positions), self.capacity)
+        with self.lock:
+            positions[:n] = state.positions[:n]
+            velocities[:n] = state.velocities[:n]
+            accelerations[:n] = state.accelerations[:n]
+            groups[:n] = state.groups[:n]
+            self.info[:] = [n, state.numAgentsInGoal, state.runningTimePerStep or 0.0, state.totalDistanceTravelled]
+            self.sequence.value += 1
+
+    # Returns a copy of the latest frame, or None if no frame newer than lastSequence has been published
+    def read(self, lastSequence, boundaryMap):
+        if self.sequence.value == lastSequence:
+            return None
+        positions, velocities, accelerations, groups = self.views()
+        with self.lock:
+            n = int(self.info[0])
+            return Frame(self.sequence.value, positions[:n].copy(), velocities[:n].copy(), accelerations[:n].copy(),
+                         groups[:n].astype(int), self.info[1], self.info[2], self.info[3], boundaryMap)
+
+# Renderer process: owns the Qt application and a PedsimVisualizer and draws the latest published frame.
+# Buttons of the window are mirrored into the shared flags running and terminate. A frame is only read (taking the lock
+# publish needs) once the next one is due by plotRefreshRate, until then the window handles events and sleeps.
+def _runRenderer(frameBuffer, running, terminate, stop, clearCount, visualizerArgs):
+    MAX_SLEEP = 0.02 # Longest sleep between handling window events, keeps the buttons responsive
+    visualizer = PedsimVisualizer(*visualizerArgs)
+    boundaryMap = visualizerArgs[6]
+    lastSequence = 0
+    lastClearCount = 0
+    while not stop.value and not visualizer.terminate:
+        running.value = visualizer.running
+        if clearCount.value != lastClearCount:
+            lastClearCount = clearCount.value
+            visualizer.clear()
+        wait = visualizer.plotTime + visualizer.plotRefreshRate/1000.0 - time.perf_counter()
+        frame = frameBuffer.read(lastSequence, boundaryMap) if visualizer.running and wait <= 0 else None
+        if frame is None:
+            visualizer.app.processEvents()
+            time.sleep(min(max(wait, 0.002), MAX_SLEEP))
+        else:
+            lastSequence = frame.sequence
+            visualizer.visualize(frame)
+    terminate.value = visualizer.terminate
+
+# Stand-in for PedsimVisualizer used by Pedsim which renders in a separate process.
+# visualize only publishes a snapshot into a FrameBuffer, so the simulation never waits for Qt.
+# running and terminate reflect the buttons of the window in the renderer process.
+class AsyncVisualizer:
+    def __init__(self, plotdirections, plotaccelerations, plotRefreshRate, dt, enablePlotting, scientificplot, boundaryMap, capacity, obstacleMap=None):
+        context = multiprocessing.get_context('spawn')
+        self.frameBuffer = FrameBuffer(capacity, context)
+        self.runningFlag = context.RawValue('b', True)
+        self.terminateFlag = context.RawValue('b', False)
+        self.stopFlag = context.RawValue('b', False)
+        self.clearCount = context.RawValue('q', 0)
+        visualizerArgs = (plotdirections, plotaccelerations, plotRefreshRate, dt, enablePlotting, scientificplot, boundaryMap, obstacleMap)
+        self.process = context.Process(target=_runRenderer, args=(self.frameBuffer, self.runningFlag, self.terminateFlag, self.stopFlag, self.clearCount, visualizerArgs), daemon=True)
+        self.process.start()
+
+    @property
+    def running(self):
+        return bool(self.runningFlag.value)
+
+    @property
+    def terminate(self):
+        return bool(self.terminateFlag.value) or not self.process.is_alive()
+
+    def visualize(self, state):
+        if self.running:
+            self.frameBuffer.publish(state)
+        else:
+            time.sleep(0.01) # Paused, do not spin
+
+    def clear(self):
+        self.clearCount.value += 1
+
+    def close(self):
+        self.stopFlag.value = True
+        self.process.join()
@@ -0,0 +1,133 @@
+import numpy as np
+import time
+import math
+import json
+
+# Per-phase timing of simulation steps. Code around a phase does
+#     start = profiler.clock()
+#     ...
+#     profiler.record('pairForces', start)
+# and Pedsim.simulate calls profiler.endStep() before every step, so the time a phase took in one step
+# (everything recorded between two calls of simulate, summed if the phase ran several times) becomes one
+# sample of that phase. Samples go into fixed size histograms, so memory does not grow with the number of steps.
+# Engines and Pedsim hold NULL_PROFILER unless profiling is enabled, whose clock and record do nothing.
+
+# Phases recorded by Pedsim, the engines and the integrators, in the order they are reported
+PHASES = ['step', 'navigation', 'neighborSearch', 'drivingForces', 'wallForces', 'pairForces', 'fluctuations', 'forceKernel',
+          'agentForces', 'integration', 'goals', 'metrics', 'boundary', 'recording', 'snapshot', 'rendering']
+
+# Histogram of durations in logarithmic bins, binsPerDecade bins per factor 10 between minTime and maxTime seconds
+# (durations outside are counted in the first and last bin). Percentiles are the geometric centre of their bin,
+# i.e. accurate to a factor 10^(0.5/binsPerDecade), about 6% with the default 20 bins per decade.
+class PhaseHistogram:
+    def __init__(self, minTime=1e-7, maxTime=1e2, binsPerDecade=20):
+        self.minTime = minTime
+        self.binsPerDecade = binsPerDecade
+        self.logMinTime = math.log10(minTime)
+        self.numBins = int(round((math.log10(maxTime) - self.logMinTime)*binsPerDecade))
+        self.counts = np.zeros(self.numBins, dtype=np.int64)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, duration):
+        if duration > 0:
+            index = int((math.log10(duration) - self.logMinTime)*self.binsPerDecade)
+            index = min(max(index, 0), self.numBins-1)
+        else:
+            index = 0
+        self.counts[index] += 1
+        self.count += 1
+        self.total += duration
+        self.max = max(self.max, duration)
+
+    def merge(self, other):
+        self.counts += other.counts
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+
+    # Duration below which a fraction q of the samples lie
+    def percentile(self, q):
+        if self.count == 0:
+            return np.nan
+        index = int(np.searchsorted(np.cumsum(self.counts), q*self.count))
+        return min(10**(self.logMinTime + (index + 0.5)/self.binsPerDecade), self.max)
+
+    def summary(self):
+        return {'count': self.count, 'total': self.total, 'mean': self.total/self.count if self.count else np.nan,
+                'p50': self.percentile(0.50), 'p95': self.percentile(0.95), 'p99': self.percentile(0.99), 'max': self.max}
+
+# Collects per-step phase durations into one PhaseHistogram per phase
+class PhaseProfiler:
+    enabled = True
+
+    def __init__(self):
+        self.clock = time.perf_counter
+        self.histograms = {}
+        self.currentStep = {}
+
+    def record(self, phase, start):
+        self.currentStep[phase] = self.currentStep.get(phase, 0.0) + time.perf_counter() - start
+
+    # Ends the current step, adding the time of every phase recorded since the last call to its histogram
+    def endStep(self):
+        for phase, duration in self.currentStep.items():
+            if phase not in self.histograms:
+                self.histograms[phase] = PhaseHistogram()
+            self.histograms[phase].add(duration)
+        self.currentStep.clear()
+
+    # Returns the histograms collected so far and starts over, used to move them out of sweep worker processes
+    def drain(self):
+        self.endStep()
+        histograms = self.histograms
+        self.histograms = {}
+        return histograms
+
+    def merge(self, histograms):
+        for phase, histogram in histograms.items():
+            if phase not in self.histograms:
+                self.histograms[phase] = PhaseHistogram(histogram.minTime, 10**(histogram.logMinTime + histogram.numBins/float(histogram.binsPerDecade)), histogram.binsPerDecade)
+            self.histograms[phase].merge(histogram)
+
+    # {phase: {'count', 'total', 'mean', 'p50', 'p95', 'p99', 'max'}} in seconds, phases in PHASES order
+    def report(self):
+        self.endStep()
+        order = PHASES + sorted(set(self.histograms) - set(PHASES))
+        return dict((phase, self.histograms[phase].summary()) for phase in order if phase in self.histograms)
+
+    def printReport(self):
+        report = self.report()
+        print('%-16s %10s %10s %10s %10s %10s %10s %10s' % ('phase', 'steps', 'mean us', 'p50 us', 'p95 us', 'p99 us', 'max us', 'total s'))
+        for phase in PHASES + sorted(set(report) - set(PHASES)):
+            if phase not in report:
+                continue
+            s = report[phase]
+            print('%-16s %10d %10.1f %10.1f %10.1f %10.1f %10.1f %10.3f' % (phase, s['count'], 1e6*s['mean'], 1e6*s['p50'], 1e6*s['p95'], 1e6*s['p99'], 1e6*s['max'], s['total']))
+
+    def dump(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.report(), f, indent=2)
+
+# Profiler which records nothing, the default of Pedsim and the engines. Costs one method call per phase.
+class NullProfiler:
+    enabled = False
+
+    @staticmethod
+    def clock():
+        return 0.0
+
+    def record(self, phase, start):
+        pass
+
+    def endStep(self):
+        pass
+
+    def drain(self):
+        return {}
+
+    def merge(self, histograms):
+        pass
+
+NULL_PROFILER = NullProfiler()
@@ -0,0 +1,43 @@
+import csv
+import os
+
+# Append-only CSV file holding the result of every finished (mean, variance, repetition) job of a sweep.
+# Each row is flushed and fsynced as soon as the job is done, so a crashed or killed sweep loses
+# at most the jobs that were running. Rows are keyed by the job parameters and the master seed,
+# so a resumed sweep only reuses results which were produced from the same random streams.
+# A result is [efficiency, discomfort, termination], termination being the reason the run ended (see runcontroller.py).
+class ResultStore:
+    FIELDS = ['mean', 'variance', 'repetition', 'seed', 'efficiency', 'discomfort', 'termination']
+
+    def __init__(self, path, resume):
+        self.path = path
+        self.results = {}
+        if resume and os.path.exists(path):
+            with open(path, newline='') as f:
+                for row in csv.DictReader(f):
+                    key = (float(row['mean']), float(row['variance']), int(row['repetition']), int(row['seed']))
+                    self.results[key] = [float(row['efficiency']), float(row['discomfort']), row.get('termination') or '']
+        else:
+            with open(path, 'w', newline='') as f:
+                csv.writer(f).writerow(self.FIELDS)
+        self.file = open(path, 'a', newline='')
+        self.writer = csv.writer(self.file)
+
+    # Master seed of the stored results, None if the store is empty
+    def seed(self):
+        for key in self.results:
+            return key[3]
+        return None
+
+    def get(self, mean, variance, repetition, seed):
+        return self.results.get((float(mean), float(variance), repetition, seed))
+
+    def append(self, mean, variance, repetition, seed, result):
+        efficiency, discomfort, termination = result
+        self.writer.writerow([repr(float(mean)), repr(float(variance)), repetition, seed, repr(float(efficiency)), repr(float(discomfort)), termination])
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.results[(float(mean), float(variance), repetition, seed)] = [efficiency, discomfort, termination]
+
+    def close(self):
+        self.file.close()
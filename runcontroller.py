@@ -0,0 +1,83 @@
+import numpy as np
+import collections
+
+# Reasons a run ends, stored next to its result
+GOAL = 'goal' # numGoals goal events were counted
+MAX_TIME = 'maxTime' # maxTime simulated seconds have passed
+STALLED = 'stalled' # the agents have (nearly) stopped moving, e.g. in a jam of opposing flows
+STEADY = 'steady' # the measures of the run no longer change
+QUIT = 'quit' # the plot window was closed
+
+# Decides when a run ends. update(state) is called before every step and returns the reason the run ends, or None to go on.
+# Besides the goal count every criterion is optional (0 disables it):
+#  - maxTime: cap on the simulated time of a run.
+#  - stallTime: the run has stalled when the mean speed of the agents still walking to their goal, exponentially averaged
+#    over the last stallTime simulated seconds, is below stallSpeed times their mean preferred speed.
+#  - steadyTolerance: the run is in steady state when the measures reported by measure(state) (the running efficiency
+#    and discomfort estimators) have stayed within steadyTolerance of each other over the last steadyTime simulated seconds.
+#    They are sampled STEADY_SAMPLES times per steadyTime.
+# Its state is kept in the PedsimState (state.controller), so it is saved with snapshots.
+class RunController:
+    STEADY_SAMPLES = 10
+
+    def __init__(self, numGoals, maxTime=0.0, stallTime=0.0, stallSpeed=0.05, steadyTolerance=0.0, steadyTime=10.0, measure=None):
+        self.numGoals = numGoals
+        self.maxTime = maxTime
+        self.stallTime = stallTime
+        self.stallSpeed = stallSpeed
+        self.steadyTolerance = steadyTolerance
+        self.steadyTime = steadyTime
+        self.measure = measure
+        self.reason = None
+        self.lastTime = None
+        self.windowSpeed = 0.0
+        self.windowPreferredSpeed = 0.0
+        self.samples = collections.deque(maxlen=self.STEADY_SAMPLES + 1)
+        self.nextSampleTime = 0.0
+
+    # measure is a bound method of Pedsim, which is not saved with the state
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['measure'] = None
+        return state
+
+    def update(self, state):
+        if self.reason is not None:
+            return self.reason
+        if state.numAgentsInGoal >= self.numGoals:
+            self.reason = GOAL
+        elif self.maxTime > 0 and state.time >= self.maxTime:
+            self.reason = MAX_TIME
+        elif state.nTimesteps > 0 and self.lastTime != state.time:
+            self.lastTime = state.time
+            if self.stallTime > 0 and self.stalled(state):
+                self.reason = STALLED
+            elif self.steadyTolerance > 0 and self.measure is not None and self.steady(state):
+                self.reason = STEADY
+        return self.reason
+
+    def stalled(self, state):
+        walking = ~state.inGoal
+        if not walking.any():
+            return False
+        velocities = state.velocities[walking]
+        speeds = np.sqrt(np.einsum('ij,ij->i', velocities, velocities))
+        alpha = 1.0 - np.exp(-state.lastDt/self.stallTime)
+        # Both averages start at 0 and share their weight, so their ratio needs no correction for the missing history
+        self.windowSpeed += alpha*(np.mean(speeds) - self.windowSpeed)
+        self.windowPreferredSpeed += alpha*(np.mean(state.preferredSpeeds[walking]) - self.windowPreferredSpeed)
+        return state.time >= self.stallTime and self.windowSpeed < self.stallSpeed*self.windowPreferredSpeed
+
+    def steady(self, state):
+        if state.time < self.nextSampleTime:
+            return False
+        self.nextSampleTime = state.time + self.steadyTime/self.STEADY_SAMPLES
+        values = np.array(self.measure(state), dtype=float)
+        if not np.all(np.isfinite(values)):
+            self.samples.clear()
+            return False
+        self.samples.append(values)
+        if len(self.samples) < self.samples.maxlen:
+            return False
+        samples = np.array(self.samples)
+        return np.all(samples.max(0) - samples.min(0) < self.steadyTolerance)
@@ -0,0 +1,96 @@
+import numpy as np
+import os
+import warnings
+
+# Binary trajectory file: a 64 byte header followed by numFrames fixed size frames.
+# A frame holds the step number, the simulated time, float32 positions and velocities of all agents
+# and the cumulative number of goals each agent has reached (so goal events are the increments between frames).
+# With an open boundary the number of agents varies, rows of a frame past the agents present are NaN (goals -1).
+HEADER_DTYPE = np.dtype([('magic', 'S8'), ('numAgents', '<i8'), ('stride', '<i8'), ('numFrames', '<i8'), ('reserved', 'S32')])
+MAGIC = b'PEDTRAJ1'
+
+def frameDtype(numAgents):
+    return np.dtype([('step', '<i8'), ('time', '<f8'), ('positions', '<f4', (numAgents, 2)),
+                     ('velocities', '<f4', (numAgents, 2)), ('goals', '<i4', (numAgents,))])
+
+# Streams every stride:th step of a PedsimState to a trajectory file.
+# Frames are collected in a preallocated buffer of chunkSize frames which is written out whenever it is full,
+# so memory use is bounded by one chunk however long the run is. The header frame count is only
+# updated after a chunk is written, a crashed run therefore leaves a readable file of all complete chunks.
+class TrajectoryRecorder:
+    def __init__(self, path, numAgents, stride=1, chunkSize=256, resumeAfterStep=None):
+        self.path = path
+        self.numAgents = numAgents
+        self.stride = stride
+        self.frameDtype = frameDtype(numAgents)
+        self.buffer = np.zeros(chunkSize, dtype=self.frameDtype)
+        self.numBuffered = 0
+        self.numFrames = 0
+        # resumeAfterStep continues an existing file, dropping frames recorded after that step (e.g. after the last snapshot).
+        # Frames up to that step which never reached the file (a crash before their chunk was written) are reported.
+        if resumeAfterStep is not None and os.path.exists(path):
+            frames = readTrajectory(path)
+            self.numFrames = int(np.searchsorted(frames['step'], resumeAfterStep, side='right'))
+            lastStep = int(frames['step'][self.numFrames-1]) if self.numFrames else -1
+            del frames
+            if lastStep < resumeAfterStep - stride:
+                warnings.warn("%s ends at step %d, the frames up to step %d are missing" % (path, lastStep, resumeAfterStep))
+            self.file = open(path, 'r+b')
+            self.file.truncate(HEADER_DTYPE.itemsize + self.numFrames*self.frameDtype.itemsize)
+            self.file.seek(0, os.SEEK_END)
+        else:
+            self.file = open(path, 'w+b')
+        self.writeHeader()
+
+    def writeHeader(self):
+        header = np.zeros((), dtype=HEADER_DTYPE)
+        header['magic'] = MAGIC
+        header['numAgents'] = self.numAgents
+        header['stride'] = self.stride
+        header['numFrames'] = self.numFrames
+        position = self.file.tell()
+        self.file.seek(0)
+        self.file.write(header.tobytes())
+        self.file.seek(max(position, HEADER_DTYPE.itemsize))
+
+    # Records state if its current step is a multiple of stride
+    def record(self, state):
+        if int(state.nTimesteps) % self.stride != 0:
+            return
+        frame = self.buffer[self.numBuffered]
+        frame['step'] = state.nTimesteps
+        frame['time'] = state.time
+        n = len(state.positions)
+        frame['positions'][:n] = state.positions
+        frame['velocities'][:n] = state.velocities
+        frame['goals'][:n] = state.goalCounts
+        if n < self.numAgents:
+            frame['positions'][n:] = np.nan
+            frame['velocities'][n:] = np.nan
+            frame['goals'][n:] = -1
+        self.numBuffered += 1
+        if self.numBuffered == len(self.buffer):
+            self.flush()
+
+    def flush(self):
+        self.file.write(self.buffer[:self.numBuffered].tobytes())
+        self.numFrames += self.numBuffered
+        self.numBuffered = 0
+        self.file.flush()
+        self.writeHeader()
+
+    def close(self):
+        self.flush()
+        self.file.close()
+
+# Returns the frames of a trajectory file as a read-only memory-mapped structured array,
+# frames are only read from disk when they are accessed, e.g. readTrajectory(path)['positions'][::100, :, 0]
+def readTrajectory(path):
+    header = np.fromfile(path, dtype=HEADER_DTYPE, count=1)[0]
+    if header['magic'] != MAGIC:
+        raise ValueError("%s is not a trajectory file" % path)
+    numAgents = int(header['numAgents'])
+    numFrames = int(header['numFrames'])
+    if numFrames == 0:
+        return np.zeros(0, dtype=frameDtype(numAgents))
+    return np.memmap(path, dtype=frameDtype(numAgents), mode='r', offset=HEADER_DTYPE.itemsize, shape=(numFrames,))